@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import date, datetime
+from dateutil.relativedelta import relativedelta
+import init
+import ta
+import ohlcv_panel
+
+# Offline benchmark of the ingestion and TA stages. It writes synthetic NSE
+# and BSE bhavcopy zips for the last --days weekdays into a scratch working
+# directory, runs the pipeline stages there one after the other and stores
+# timings, throughput and peak memory of every stage in a JSON file, so runs
+# of different versions (or TA_MODE / TA_BACKEND / OHLCV_STORE settings) can
+# be compared. Example: python benchmark.py --scrips 6000 --days 1250
+
+NSE_HEADER = 'SYMBOL,SERIES,OPEN,HIGH,LOW,CLOSE,LAST,PREVCLOSE,TOTTRDQTY,TOTTRDVAL,TIMESTAMP,TOTALTRADES,ISIN,'
+BSE_HEADER = 'SC_CODE,SC_NAME,SC_GROUP,SC_TYPE,OPEN,HIGH,LOW,CLOSE,LAST,PREVCLOSE,NO_TRADES,NO_OF_SHRS,NET_TURNOV,TDCLOINDI'
+SETTINGS = ('TA_MODE', 'TA_BACKEND', 'TA_EXECUTOR', 'TA_WORKERS', 'OHLCV_STORE', 'INGEST_WORKERS', 'TA_SPEC')
+
+
+def trading_days(days):
+    t_date = date.today() + relativedelta(days=-1)
+    dates = []
+    while (len(dates) < days):
+        if (t_date.weekday() < 5):
+            dates.append(t_date)
+        t_date += relativedelta(days=-1)
+    return sorted(dates)
+
+
+def write_zip(zip_filename, csv_filename, lines):
+    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(csv_filename, '\n'.join(lines) + '\n')
+
+
+def generate_bhavcopies(dates, scrips, missing, seed):
+    # Random walks per scrip, with a share of scrips missing on every day so
+    # the scrip files have gaps like illiquid counters do.
+    rng = random.Random(seed)
+    prices = [rng.uniform(5, 3000) for _ in range(scrips)]
+    rows = 0
+    for t_date in dates:
+        nse = [NSE_HEADER]
+        bse = [BSE_HEADER]
+        for scrip in range(scrips):
+            if (rng.random() < missing):
+                continue
+            previous = prices[scrip]
+            open_price = round(previous * rng.uniform(0.98, 1.02), 2)
+            close_price = round(previous * rng.uniform(0.97, 1.03), 2)
+            prices[scrip] = close_price
+            high = max(open_price, close_price) + 0.5
+            low = max(0.05, min(open_price, close_price) - 0.5)
+            volume = rng.randint(1, 10**6)
+            nse.append('SYM%05d,EQ,%s,%s,%s,%s,%s,%s,%d,%d,%s,10,INE%05d,' % (scrip, open_price, high, low, close_price, close_price, previous, volume, volume * close_price, t_date.strftime('%d-%b-%Y').upper(), scrip))
+            bse.append('%d,NAME %d,A ,Q,%s,%s,%s,%s,%s,%s,5,%d,%d,' % (500000 + scrip, scrip, open_price, high, low, close_price, close_price, previous, volume, volume * close_price))
+            rows += 1
+
+        write_zip(init.bhavcopy_zip_filename('nse', t_date), os.path.basename(init.get_nse_csv_bhavcopy_filename(t_date)), nse)
+        write_zip(init.bhavcopy_zip_filename('bse', t_date), os.path.basename(init.get_bse_csv_bhavcopy_filename(t_date)), bse)
+
+    return rows
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+class Benchmark(object):
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    def record(self, name, seconds, rows = None, scrips = None, python_peak = None):
+        self_rss, children_rss = peak_rss_kb()
+        stage = {'name': name, 'seconds': round(seconds, 4), 'rows': rows, 'scrips': scrips,
+                 'rows_per_second': round(rows / seconds, 1) if rows and seconds > 0 else None,
+                 'scrips_per_second': round(scrips / seconds, 1) if scrips and seconds > 0 else None,
+                 'peak_rss_kb': self_rss, 'children_peak_rss_kb': children_rss,
+                 'python_peak_kb': python_peak}
+        self.stages.append(stage)
+        print('%-24s %10.3fs %14s rows/s %12s scrips/s %10d KB' % (name, seconds, stage['rows_per_second'], stage['scrips_per_second'], self_rss))
+
+    def run(self, name, function, rows = None, scrips = None):
+        if (self.trace_memory):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        python_peak = tracemalloc.get_traced_memory()[1] // 1024 if self.trace_memory else None
+        if (callable(rows)):
+            rows = rows(result)
+        if (callable(scrips)):
+            scrips = scrips(result)
+        self.record(name, seconds, rows, scrips, python_peak)
+        return result
+
+
+def parse_all(dates):
+    rows = 0
+    for t_date in dates:
+        rows += len(init.parse_nse_bhavcopy(t_date)['rows'])
+        rows += len(init.parse_bse_bhavcopy(t_date)['rows'])
+    return rows
+
+
+def history_size(exchange):
+    # (rows, scrips) stored for an exchange, in whichever OHLCV store is used.
+    if (init.OHLCV_STORE == 'panel'):
+        panel = ohlcv_panel.load_panel('data/' + exchange + '_panel')
+        return panel.rows, len(panel.codes)
+
+    rows = 0
+    filenames = init.list_of_files('data/' + exchange)
+    for filename in filenames:
+        with open('data/' + exchange + '/' + filename, 'rb') as f_handle:
+            rows += sum(chunk.count(b'\n') for chunk in iter(lambda: f_handle.read(1024 * 1024), b''))
+    return rows, len(filenames)
+
+
+def read_histories(exchange):
+    # Yields (name, Series) for every scrip of the exchange.
+    if (init.OHLCV_STORE == 'panel'):
+        panel = 'data/' + exchange + '_panel'
+        for code, columns in ohlcv_panel.read_scrips(panel, ohlcv_panel.panel_codes(panel), ta.numpy_enabled()):
+            yield code, ta.series_from_columns(columns)
+        return
+
+    for filename in sorted(init.list_of_files('data/' + exchange)):
+        yield filename[:-4], ta.read_ohlcv_data(init.ohlcv_source('data/' + exchange + '/' + filename))
+
+
+def benchmark_indicators(benchmark, exchange, destination_dir):
+    # Every indicator is timed on its own over all scrips of the exchange,
+    # summing only the time spent inside the call.
+    stages = [
+        ('ta_rsi_14', lambda data: ta.rsi(data, 14)),
+        ('ta_ema_50', lambda data: ta.moving_average(data, 'close', 50)),
+        ('ta_ema_21', lambda data: ta.moving_average(data, 'close', 21)),
+        ('ta_ema_9', lambda data: ta.moving_average(data, 'close', 9)),
+        ('ta_macd_12_26_9', lambda data: ta.macd(data, 12, 26, 9)),
+        ('ta_vol_ema_10', lambda data: ta.moving_average(data, 'volume', 10)),
+        ('ta_percent_change', lambda data: ta.percent_change(data))
+    ]
+    timings = {name: 0 for name in ['ta_read'] + [stage[0] for stage in stages] + ['ta_write']}
+    rows = 0
+    scrips = 0
+    histories = read_histories(exchange)
+
+    while True:
+        start = time.perf_counter()
+        scrip, ohlcv_data = next(histories, (None, None))
+        timings['ta_read'] += time.perf_counter() - start
+        if (ohlcv_data is None):
+            break
+        rows += len(ohlcv_data)
+        scrips += 1
+
+        for name, function in stages:
+            start = time.perf_counter()
+            function(ohlcv_data)
+            timings[name] += time.perf_counter() - start
+
+        data = ta.calculate_ta_data(ohlcv_data)
+        start = time.perf_counter()
+        ta.write_ta_data_to_file(data, destination_dir + '/' + scrip + '_TA.csv')
+        timings['ta_write'] += time.perf_counter() - start
+
+    for name in timings:
+        benchmark.record(name, timings[name], rows, scrips)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingestion and Technical Analysis on synthetic bhavcopies')
+    parser.add_argument('--scrips', type=int, default=500, help='scrips per exchange')
+    parser.add_argument('--days', type=int, default=250, help='trading days of history')
+    parser.add_argument('--missing', type=float, default=0.05, help='share of scrips missing on any day')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='scratch directory, a temporary one is used by default')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the Python heap peak of each stage')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bhavcopy_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    # A reused --workdir starts from an empty data/ and every TA file is
+    # recomputed, otherwise ingestion and TA would skip what an earlier run
+    # already did and the timings would not be comparable.
+    if (os.path.exists('data')):
+        shutil.rmtree('data')
+    init.ensure_data_dir()
+    init.TA_FORCE = '1'
+
+    dates = trading_days(args.days)
+    # init derives the bhavcopy dates from the interval in argv.
+    sys.argv = [sys.argv[0], 'd:' + str((date.today() - dates[0]).days)]
+
+    if (args.trace_memory):
+        tracemalloc.start()
+
+    benchmark = Benchmark(args.trace_memory)
+    generated = benchmark.run('generate_fixtures', lambda: generate_bhavcopies(dates, args.scrips, args.missing, args.seed), rows=lambda rows: rows * 2)
+    benchmark.run('parse_bhavcopy', lambda: parse_all(dates), rows=lambda rows: rows)
+    for exchange, process in (('nse', init.process_nse_data), ('bse', init.process_bse_data)):
+        benchmark.run('ingest_' + exchange, process, rows=generated, scrips=lambda result: history_size(exchange)[1])
+
+    os.makedirs('data/benchmark_ta', exist_ok=True)
+    benchmark_indicators(benchmark, 'nse', 'data/benchmark_ta')
+    for exchange in ('nse', 'bse'):
+        rows, scrips = history_size(exchange)
+        benchmark.run('process_ta_' + exchange, lambda: init.process_ta('data/' + exchange, 'data/ta_' + exchange), rows=rows, scrips=scrips)
+
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {'scrips': args.scrips, 'days': args.days, 'missing': args.missing, 'seed': args.seed},
+        'settings': {name: os.getenv(name) for name in SETTINGS},
+        'stages': benchmark.stages
+    }
+    with open(output, 'w') as f_handle:
+        json.dump(result, f_handle, indent=1)
+    print('Results written to ' + output)
+
+    if (not args.keep and args.workdir is None):
+        os.chdir('/')
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
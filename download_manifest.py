@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+MANIFEST_FILE = 'download_manifest.json'
+
+
+def file_digest(filename):
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f_handle:
+        for chunk in iter(lambda: f_handle.read(1024 * 1024), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return size, sha256.hexdigest()
+
+
+class DownloadManifest(object):
+    # Outcome of every bhavcopy download attempt keyed by exchange and date:
+    # status (ok / holiday / failed), HTTP status, size and sha256 of the
+    # file on disk, the total number of attempts and the last error.
+
+    def __init__(self, path = MANIFEST_FILE):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f_handle:
+                self.entries = json.load(f_handle)
+        except Exception as e:
+            self.entries = {}
+        return self
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f_handle:
+            json.dump(self.entries, f_handle, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def entry(self, exchange, t_date):
+        return self.entries.get(exchange + ':' + str(t_date))
+
+    def is_complete(self, exchange, t_date, filename):
+        entry = self.entry(exchange, t_date)
+        if (entry is None or entry['status'] != 'ok' or not os.path.exists(filename)):
+            return False
+        if (os.path.getsize(filename) != entry['size']):
+            return False
+        # The size catches truncated files cheaply, the digest a file that
+        # was changed or damaged in place.
+        return entry['sha256'] is None or file_digest(filename)[1] == entry['sha256']
+
+    def record(self, exchange, t_date, result):
+        previous = self.entry(exchange, t_date) or {}
+        if (result['status'] == 200):
+            status = 'ok'
+        elif (result['status'] == 404):
+            status = 'holiday'
+        else:
+            status = 'failed'
+
+        self.entries[exchange + ':' + str(t_date)] = {
+            'status': status,
+            'http_status': result['status'],
+            'size': result.get('size'),
+            'sha256': result.get('sha256'),
+            'attempts': previous.get('attempts', 0) + result['attempts'],
+            'error': result.get('error'),
+            'updated': datetime.now().isoformat(timespec='seconds')
+        }
+
+
+def load_manifest():
+    return DownloadManifest().load()
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import random
+import time
+import zipfile
+from urllib.parse import urlparse
+from download_manifest import file_digest
+import log_queue
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DOWNLOAD_PER_HOST_LIMIT = int(os.getenv('DOWNLOAD_PER_HOST_LIMIT', 8))
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 120))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', 4))
+DOWNLOAD_BACKOFF = float(os.getenv('DOWNLOAD_BACKOFF', 2))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Responses the exchange sites send while throttling or briefly failing.
+TRANSIENT_STATUSES = (403, 408, 429, 500, 502, 503, 504)
+
+# BSE only served wget reliably, so keep presenting the same client to it.
+HOST_HEADERS = {
+    'www.bseindia.com': {'User-Agent': 'Wget/1.20.3 (linux-gnu)'}
+}
+
+def log(message, *args, error = False):
+    if (error == True):
+        log_queue.error(message, *args)
+    else:
+        log_queue.debug(message, *args)
+
+
+def async_enabled():
+    return aiohttp is not None
+
+
+def is_transient(status):
+    return status is None or status in TRANSIENT_STATUSES
+
+
+def backoff_delay(attempt):
+    return DOWNLOAD_BACKOFF * (2 ** (attempt - 1)) + random.uniform(0, DOWNLOAD_BACKOFF)
+
+
+def verify_download(filename):
+    # Throttled requests sometimes get an HTML page with a 200 status.
+    if (not zipfile.is_zipfile(filename)):
+        raise Exception('Downloaded file is not a valid zip')
+
+
+async def fetch(session, url, filename):
+    # Bodies are streamed to a .part file that survives failures. The next
+    # attempt (or the next run) asks only for the missing bytes with a Range
+    # header and appends them when the server answers 206.
+    part_file = filename + '.part'
+    headers = dict(HOST_HEADERS.get(urlparse(url).netloc, {}))
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if (offset > 0):
+        headers['Range'] = 'bytes=' + str(offset) + '-'
+
+    async with session.get(url, headers=headers) as response:
+        if (response.status == 416):
+            os.remove(part_file)
+            return None
+        if (response.status not in (200, 206)):
+            return response.status
+
+        with open(part_file, 'ab' if response.status == 206 else 'wb') as zip_file:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                zip_file.write(chunk)
+
+    try:
+        verify_download(part_file)
+    except Exception as e:
+        os.remove(part_file)
+        raise
+
+    os.replace(part_file, filename)
+    return 200
+
+
+async def download_file(session, limits, url, filename):
+    result = {'status': None, 'attempts': 0, 'size': None, 'sha256': None, 'error': None, 'seconds': None}
+    log('Download zipfile %s: Starting', filename)
+    start = time.perf_counter()
+
+    while True:
+        result['attempts'] += 1
+        try:
+            async with limits[urlparse(url).netloc]:
+                result['status'] = await fetch(session, url, filename)
+            result['error'] = None if result['status'] == 200 else 'HTTP ' + str(result['status'])
+        except Exception as e:
+            result['status'] = None
+            result['error'] = str(e) or e.__class__.__name__
+
+        if (not is_transient(result['status']) or result['attempts'] >= DOWNLOAD_RETRIES):
+            break
+
+        log('Download zipfile %s: Retrying after %s', filename, result['error'])
+        await asyncio.sleep(backoff_delay(result['attempts']))
+
+    result['seconds'] = time.perf_counter() - start
+    if (result['status'] == 200):
+        result['size'], result['sha256'] = file_digest(filename)
+        log('Download zipfile %s: Completed', filename)
+    elif (result['status'] == 404):
+        log('Download zipfile %s: Failed (May be Holiday)', filename)
+    else:
+        log('Download zipfile %s: Failed (%s)', filename, result['error'], error=True)
+
+    return result
+
+
+async def download_all(jobs):
+    # One pooled keep-alive connector for every host, and a semaphore per host
+    # so a slow exchange site cannot starve the other one.
+    limits = {}
+    for url, filename in jobs:
+        limits[urlparse(url).netloc] = asyncio.Semaphore(DOWNLOAD_PER_HOST_LIMIT)
+
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=DOWNLOAD_PER_HOST_LIMIT, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*[download_file(session, limits, url, filename) for url, filename in jobs])
+
+    return {filename: result for (url, filename), result in zip(jobs, results)}
+
+
+def download_files(jobs):
+    return asyncio.run(download_all(jobs))
@@ -0,0 +1,79 @@
+import csv
+from array import array
+from operator import itemgetter
+
+try:
+    import numpy as np
+    import ta_numpy
+except ImportError:
+    np = None
+
+# Positional parsing of the fixed CSV schemas (bhavcopies and the 6 field
+# scrip files) instead of a csv.DictReader dict per row. Lines are split on
+# ',' and only the columns a caller asks for are picked, numeric columns are
+# converted a whole column at a time. Prices are rounded like ta.i2f.
+
+OHLCV_FIELDS = ['date', 'open', 'high', 'low', 'close', 'volume']
+
+
+def split_line(line):
+    # Quoted fields (a comma in a BSE scrip name) fall back to the csv module.
+    if ('"' in line):
+        return next(csv.reader([line]))
+    return line.split(',')
+
+
+def select_columns(text, names):
+    # Yields a tuple of the named columns for every data row, the positions
+    # are looked up in the header line. Short rows are skipped.
+    lines = text.split('\n')
+    header = split_line(lines[0])
+    indices = [header.index(name) for name in names]
+    width = max(indices) + 1
+    getter = itemgetter(*indices)
+    for line in lines[1:]:
+        if (line == ''):
+            continue
+        fields = split_line(line)
+        if (len(fields) >= width):
+            yield getter(fields)
+
+
+def price_values(values, use_numpy = False):
+    if (use_numpy):
+        return ta_numpy.round_values(np.fromiter(map(float, values), np.float64, len(values)))
+    return array('d', [round(float(value), 4) for value in values])
+
+
+def volume_values(values, use_numpy = False):
+    if (use_numpy):
+        return np.fromiter(map(int, values), np.int64, len(values))
+    return array('q', map(int, values))
+
+
+def read_ohlcv_columns(text, fields = OHLCV_FIELDS[1:], use_numpy = False):
+    # Returns the dates and the requested fields of a scrip file. With
+    # use_numpy (numpy required) the columns are numpy arrays.
+    use_numpy = use_numpy and np is not None
+    rows = [line.split(',') for line in text.splitlines() if line != '']
+    if (len(rows) == 0):
+        return [], {field: volume_values([], use_numpy) if field == 'volume' else price_values([], use_numpy) for field in fields}
+
+    columns = list(zip(*rows))
+    values = {}
+    for field in fields:
+        column = columns[OHLCV_FIELDS.index(field)]
+        values[field] = volume_values(column, use_numpy) if field == 'volume' else price_values(column, use_numpy)
+    return list(columns[0]), values
+
+
+def read_ohlcv_rows(text):
+    # Rows of a scrip file as dicts of converted values, for per-bar consumers.
+    rows = []
+    for line in text.splitlines():
+        if (line == ''):
+            continue
+        fields = line.split(',')
+        rows.append({'date': fields[0], 'open': round(float(fields[1]), 4), 'high': round(float(fields[2]), 4),
+                     'low': round(float(fields[3]), 4), 'close': round(float(fields[4]), 4), 'volume': int(fields[5])})
+    return rows
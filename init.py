@@ -4,22 +4,62 @@ import shutil
 import requests
 import subprocess
 import threading
+import time
 import concurrent.futures
+import multiprocessing
 import zipfile
-import csv
+import io
+import json
+import fast_csv
 import ta
+import ta_incremental
+import ta_stream
+import ohlcv_store
+try:
+    import ta_market
+except ImportError:
+    ta_market = None
+import downloader
+import log_queue
+import profiling
+from scrip_writer import ScripDataWriter
+from ohlcv_panel import OhlcvPanel, load_panel, panel_codes
+from ta_manifest import load_ta_manifest
+from scrip_registry import load_registry
+from trading_calendar import load_calendar
+from download_manifest import load_manifest, file_digest, MANIFEST_FILE
+from metrics import METRICS, timed
+from profiling import profiled
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
 MONTHS = ['', 'JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
 MONTHS_NUM = ['00', '01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
 DAYS = ['00', '01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23', '24', '25', '26', '27', '28', '29', '30', '31']
-
-LOG_ENABLED = os.getenv('LOG_DEV', False)
-
-def log(message, error = False):
-    if (error == True or LOG_ENABLED != False):
-        print(message)
+DATA_DIRS = ('bse_bhavcopy', 'nse_bhavcopy', 'data', 'data/bse', 'data/nse', 'data/ta_bse', 'data/ta_nse', 'data/ta_state_bse', 'data/ta_state_nse', 'data/bse_ohlcv', 'data/nse_ohlcv')
+EXCHANGES = ('nse', 'bse')
+# Bhavcopy columns read by parse_*_bhavcopy, in the order they are unpacked.
+NSE_COLUMNS = ['SYMBOL', 'SERIES', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'TOTTRDQTY']
+BSE_COLUMNS = ['SC_CODE', 'SC_NAME', 'SC_TYPE', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'NO_OF_SHRS']
+
+TA_EXECUTOR = os.getenv('TA_EXECUTOR', 'process')
+TA_WORKERS = int(os.getenv('TA_WORKERS', os.cpu_count() or 1))
+TA_CHUNK_SIZE = int(os.getenv('TA_CHUNK_SIZE', 50))
+TA_FULL_UPDATE = os.getenv('TA_FULL_UPDATE', False)
+TA_FORCE = os.getenv('TA_FORCE', False)
+INIT_FRESH = os.getenv('INIT_FRESH', False)
+DOWNLOAD_ENGINE = os.getenv('DOWNLOAD_ENGINE', 'async')
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1))
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 4))
+OHLCV_STORE = os.getenv('OHLCV_STORE', 'binary')
+TA_MODE = os.getenv('TA_MODE', 'scrip')
+TA_MARKET_CHUNK_SIZE = int(os.getenv('TA_MARKET_CHUNK_SIZE', 1000))
+
+def log(message, *args, error = False):
+    if (error == True):
+        log_queue.error(message, *args)
+    else:
+        log_queue.debug(message, *args)
 
 
 def remove_data_dir():
@@ -28,21 +68,26 @@ def remove_data_dir():
         for folder_to_delete in ('nse_bhavcopy', 'bse_bhavcopy', 'data'):
             if(os.path.exists(folder_to_delete)):
                 shutil.rmtree(folder_to_delete)
-        if(os.path.exists('wget_log.log')):
-            os.remove('wget_log.log')
+        for file_to_delete in ('wget_log.log', MANIFEST_FILE):
+            if(os.path.exists(file_to_delete)):
+                os.remove(file_to_delete)
         log('Delete existing data: Completed')
     except:
-        log('Delete existing data: Failed', True)
+        log('Delete existing data: Failed', error=True)
 
 def create_data_dir():
     try:
         remove_data_dir()
         log('Create required directories: Starting')
-        for dir_to_create in ('bse_bhavcopy', 'nse_bhavcopy', 'data', 'data/bse', 'data/nse', 'data/ta_bse', 'data/ta_nse'):
+        for dir_to_create in DATA_DIRS:
             os.mkdir(dir_to_create)
         log('Create required directories: Completed')
     except:
-        log('Create required directories: Failed', True)
+        log('Create required directories: Failed', error=True)
+
+def ensure_data_dir():
+    for dir_to_create in DATA_DIRS:
+        os.makedirs(dir_to_create, exist_ok=True)
 
 def default_interval():
     return date.today() + relativedelta(days=-1) + relativedelta(months=-6)
@@ -96,119 +141,203 @@ def get_bse_bhavcopy_url(t_date):
     return 'https://www.bseindia.com/download/BhavCopy/Equity/'+get_bse_bhavcopy_filename(t_date)
 
 def download_zip_file(url, filename):
-    log('Download zipfile ' + filename + ': Starting')
-    response = requests.get(url)
+    log('Download zipfile %s: Starting', filename)
+    # Without a timeout a stalled connection would never reach the retries.
+    response = requests.get(url, timeout=downloader.DOWNLOAD_TIMEOUT)
     
     if (response.status_code != 200):
-        log('Download zipfile ' + filename + ': Failed (May be Holiday)')
-        return
+        log('Download zipfile %s: Failed (May be Holiday)', filename)
+        return response.status_code
 
     with open(filename, 'wb') as zip_file:
         zip_file.write(response.content)
     
-    log('Download zipfile ' + filename + ': Completed')
+    log('Download zipfile %s: Completed', filename)
+    return response.status_code
 
 def download_zip_file_using_wget(url, filename):
-    log('Download zipfile ' + filename + ': Starting')
-    if (LOG_ENABLED != False):
-        return_status = subprocess.call(['wget', '-O', filename, '-a', 'wget_log.log', url])
-    else:
-        return_status = subprocess.call(['wget', '-O', filename, '-q', url])
-
-    if(return_status != 0):
-        log('Download zipfile ' + filename + ': Failed (May be Holiday)')
+    log('Download zipfile %s: Starting', filename)
+    process = subprocess.run(['wget', '-O', filename, '-nv', '--server-response', url], stderr=subprocess.PIPE, text=True, errors='replace')
+    if (log_queue.enabled(log_queue.DEBUG)):
+        with open('wget_log.log', 'a') as f_handle:
+            f_handle.write(process.stderr)
+
+    if(process.returncode != 0):
+        log('Download zipfile %s: Failed (May be Holiday)', filename)
         if(os.path.exists(filename)):
-            log('Deleting trash file: ' + filename)
+            log('Deleting trash file: %s', filename)
             os.remove(filename)
-        return
-
-    log('Download zipfile ' + filename + ': Completed')
+        # wget exits with 8 for any error response from the server, the
+        # status it printed tells a holiday (404) from throttling. Without
+        # one it was a network failure, reported as None like the other
+        # downloaders do.
+        if(process.returncode == 8):
+            return wget_http_status(process.stderr)
+        return None
+
+    log('Download zipfile %s: Completed', filename)
+    return 200
+
+def wget_http_status(output):
+    # The last status line of --server-response, redirects print one each.
+    status = None
+    for line in output.splitlines():
+        fields = line.split()
+        if (len(fields) >= 2 and fields[0].startswith('HTTP/') and fields[1].isdigit()):
+            status = int(fields[1])
+    return status
 
 def download_nse_bhavcopy(t_date):
     zip_file_name = get_nse_bhavcopy_filename(t_date)
-    download_zip_file(get_nse_bhavcopy_url(t_date), 'nse_bhavcopy/'+zip_file_name)
+    return download_zip_file(get_nse_bhavcopy_url(t_date), 'nse_bhavcopy/'+zip_file_name)
 
 def download_bse_bhavcopy(t_date):
     zip_file_name = get_bse_bhavcopy_filename(t_date)
-    download_zip_file_using_wget(get_bse_bhavcopy_url(t_date), 'bse_bhavcopy/'+zip_file_name)
-
+    return download_zip_file_using_wget(get_bse_bhavcopy_url(t_date), 'bse_bhavcopy/'+zip_file_name)
+
+def download_bhavcopy(exchange, t_date):
+    if (exchange == 'nse'):
+        return download_nse_bhavcopy(t_date)
+    return download_bse_bhavcopy(t_date)
+
+def bhavcopy_url(exchange, t_date):
+    if (exchange == 'nse'):
+        return get_nse_bhavcopy_url(t_date)
+    return get_bse_bhavcopy_url(t_date)
+
+def bhavcopy_zip_filename(exchange, t_date):
+    if (exchange == 'nse'):
+        return 'nse_bhavcopy/'+get_nse_bhavcopy_filename(t_date)
+    return 'bse_bhavcopy/'+get_bse_bhavcopy_filename(t_date)
+
+def bhavcopy_csv_filename(exchange, t_date):
+    if (exchange == 'nse'):
+        return get_nse_csv_bhavcopy_filename(t_date)
+    return get_bse_csv_bhavcopy_filename(t_date)
+
+def plan_downloads(dates, calendar, manifest):
+    on_disk = set()
+    for exchange in EXCHANGES:
+        for filename in list_of_files(exchange + '_bhavcopy'):
+            on_disk.add(exchange + '_bhavcopy/' + filename)
+
+    plan = []
+    for t_date in dates:
+        if (t_date > date.today()):
+            continue
+
+        for exchange in EXCHANGES:
+            if (not calendar.is_trading_day(exchange, t_date)):
+                METRICS.increment('download.skipped_holiday')
+                log('Download of %s bhavcopy for date %s Skipped: (Holiday)', exchange, t_date)
+            elif (is_downloaded(exchange, t_date, on_disk, manifest)):
+                METRICS.increment('download.skipped_downloaded')
+                log('Download of %s bhavcopy for date %s Skipped: (Already downloaded)', exchange, t_date)
+            else:
+                plan.append((exchange, t_date))
+
+    return plan
+
+def is_downloaded(exchange, t_date, on_disk, manifest):
+    if (bhavcopy_csv_filename(exchange, t_date) in on_disk):
+        return True
+
+    zip_filename = bhavcopy_zip_filename(exchange, t_date)
+    if (zip_filename not in on_disk):
+        return False
+
+    if (manifest.entry(exchange, t_date) is not None):
+        return manifest.is_complete(exchange, t_date, zip_filename)
+
+    # Zips from before the manifest existed are trusted if they open, a
+    # truncated one is removed and downloaded again.
+    if (not zipfile.is_zipfile(zip_filename)):
+        log('Removing damaged bhavcopy %s', zip_filename)
+        os.remove(zip_filename)
+        return False
+    return True
+
+def download_bhavcopy_with_retries(exchange, t_date):
+    filename = bhavcopy_zip_filename(exchange, t_date)
+    result = {'status': None, 'attempts': 0, 'size': None, 'sha256': None, 'error': None, 'seconds': None}
+    start = time.perf_counter()
+
+    while True:
+        result['attempts'] += 1
+        try:
+            result['status'] = download_bhavcopy(exchange, t_date)
+            if (result['status'] == 200):
+                downloader.verify_download(filename)
+            result['error'] = None if result['status'] == 200 else 'HTTP ' + str(result['status'])
+        except Exception as e:
+            if (os.path.exists(filename)):
+                os.remove(filename)
+            result['status'] = None
+            result['error'] = str(e)
+
+        if (not downloader.is_transient(result['status']) or result['attempts'] >= downloader.DOWNLOAD_RETRIES):
+            break
+        time.sleep(downloader.backoff_delay(result['attempts']))
+
+    result['seconds'] = time.perf_counter() - start
+    if (result['status'] == 200):
+        result['size'], result['sha256'] = file_digest(filename)
+    return result
+
+@timed('stage.download_historic_data')
+@profiled('download_historic_data')
 def download_historic_data():
     itr_date = return_init_date()
     curr_date = date.today()
 
-    log('Download bhavcopy from ' + str(itr_date) + ' to ' + str(curr_date) + ': Starting')
-
-    with concurrent.futures.ThreadPoolExecutor(50) as executor:
-        futures = []
-        while curr_date >= itr_date:
-            itr_date += relativedelta(days=+1)
-            
-            if (itr_date.weekday() > 4):
-                log('Download of bhavcopy for date ' + str(itr_date) + ' Skipped: (Holiday)')
-                continue
-            
-            futures.append(executor.submit(download_nse_bhavcopy, t_date=itr_date))
-            futures.append(executor.submit(download_bse_bhavcopy, t_date=itr_date))
+    log_queue.info('Download bhavcopy from %s to %s: Starting', itr_date, curr_date)
 
-    log('Download bhavcopy from ' + str(itr_date) + ' to ' + str(curr_date) + ': Completed')
+    calendar = load_calendar()
+    manifest = load_manifest()
+    plan = plan_downloads(bhavcopy_dates(), calendar, manifest)
+    log_queue.info('Downloading %d missing bhavcopies', len(plan))
 
-def unzip_file(filename, target_dir):
-    log('Extracting file ' + filename + ' to ' + target_dir)
-    with zipfile.ZipFile(filename,'r') as zip_ref:
-        zip_ref.extractall(target_dir)
+    if (DOWNLOAD_ENGINE == 'async' and downloader.async_enabled()):
+        downloaded = downloader.download_files([(bhavcopy_url(exchange, t_date), bhavcopy_zip_filename(exchange, t_date)) for exchange, t_date in plan])
+        results = [downloaded[bhavcopy_zip_filename(exchange, t_date)] for exchange, t_date in plan]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(50) as executor:
+            futures = [executor.submit(download_bhavcopy_with_retries, exchange, t_date) for exchange, t_date in plan]
+            results = [future.result() for future in futures]
+
+    # A missing bhavcopy for a past trading day means the exchange was closed,
+    # remember it so later runs do not ask for it again.
+    failed = []
+    for (exchange, t_date), result in zip(plan, results):
+        manifest.record(exchange, t_date, result)
+        record_download(bhavcopy_url(exchange, t_date), result['status'], result['seconds'])
+        if (result['status'] == 404 and t_date < date.today()):
+            calendar.mark_holiday(exchange, t_date)
+        elif (result['status'] != 200 and result['status'] != 404):
+            failed.append(exchange + ' ' + str(t_date) + ' (' + str(result['error']) + ')')
+
+    manifest.save()
+    if (calendar.changed):
+        calendar.save()
+
+    if (len(failed) > 0):
+        log('Download of %d bhavcopies failed after retries: %s', len(failed), ', '.join(failed), error=True)
+
+    log_queue.info('Download bhavcopy from %s to %s: Completed', itr_date, curr_date)
+
+def record_download(url, status, seconds):
+    METRICS.add_time('download.url', seconds)
+    METRICS.set_value('download_seconds', url, round(seconds, 3))
+    if (status == 200):
+        METRICS.increment('download.ok')
+    elif (status == 404):
+        METRICS.increment('download.holiday')
+    else:
+        METRICS.increment('download.failed')
 
 def list_of_files(target_dir):
     return [f for f in os.listdir(target_dir) if os.path.isfile(os.path.join(target_dir, f))]
 
-def list_of_dirs(target_dir):
-    return [f for f in os.listdir(target_dir) if os.path.isdir(os.path.join(target_dir, f))]
-
-def is_zip(filename):
-    return filename.endswith('.zip') or filename.endswith('.ZIP')
-
-def extract_all_files_in_dir(target_dir):
-    log('Extracting all zip files in: ' + target_dir)
-    for file_to_extract in list_of_files(target_dir):
-        if (is_zip(file_to_extract)):
-            unzip_file(target_dir+'/'+file_to_extract, target_dir)
-
-def flatten_structure(curr_dir, root_dir):
-    log('Flattenning directory structure for: ' + curr_dir)
-    
-    for dir_to_flatten in list_of_dirs(curr_dir):    
-        for file_to_move in list_of_files(curr_dir+'/'+dir_to_flatten):
-            shutil.move(curr_dir+'/'+dir_to_flatten+'/'+file_to_move, root_dir+'/temp_'+file_to_move)
-        
-        flatten_structure(curr_dir+'/'+dir_to_flatten, root_dir)
-        
-        log('Removing nested directory: ' + curr_dir+'/'+dir_to_flatten)
-        shutil.rmtree(curr_dir+'/'+dir_to_flatten)
-
-def flatten_nse_structure():
-    flatten_structure('nse_bhavcopy', 'nse_bhavcopy')
-
-    for filename in list_of_files('nse_bhavcopy'):
-        if (filename.startswith('temp_')):
-            actual_filename = filename[5:]
-            log('Renaming temporary file nse_bhavcopy/' + filename + ' to actual filename ' + actual_filename)
-            os.rename('nse_bhavcopy/'+filename, 'nse_bhavcopy/'+actual_filename)
-
-def delete_zipfiles(target_dir):
-    log('Deleting all zip files in ' + target_dir)
-    for filename in list_of_files(target_dir):
-        if (is_zip(filename)):
-            os.remove(target_dir+'/'+filename)
-            log('Zip File ' + target_dir+'/'+filename + ' deleted.')
-
-def process_nse_bhavcopy():
-    extract_all_files_in_dir('nse_bhavcopy')
-    flatten_nse_structure()
-    delete_zipfiles('nse_bhavcopy')
-
-def process_bse_bhavcopy():
-    extract_all_files_in_dir('bse_bhavcopy')
-    delete_zipfiles('bse_bhavcopy')
-
 def get_bse_csv_bhavcopy_filename(t_date):
     month = MONTHS_NUM[t_date.month]
     year = str(t_date.year % 2000)
@@ -221,78 +350,333 @@ def get_nse_csv_bhavcopy_filename(t_date):
     day = DAYS[t_date.day]
     return 'nse_bhavcopy/cm'+day+month+year+'bhav.csv'
 
-def generate_bse_data(t_date):
+def bhavcopy_member(zip_ref, csv_filename):
+    members = [member for member in zip_ref.namelist() if member.lower().endswith('.csv')]
+    for member in members:
+        if (os.path.basename(member).lower() == csv_filename.lower()):
+            return member
+    if (len(members) == 0):
+        raise Exception('No csv file found in bhavcopy zip for ' + csv_filename)
+    return members[0]
+
+def bhavcopy_text(zip_filename, csv_filename):
+    # The csv is read straight out of the zip, NSE zips may nest it in a
+    # folder. An already extracted csv from an older run is still read
+    # directly.
+    if (not os.path.exists(zip_filename)):
+        with open(csv_filename, 'r') as f_handle:
+            return f_handle.read()
+
+    with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
+        with zip_ref.open(bhavcopy_member(zip_ref, os.path.basename(csv_filename))) as member_handle:
+            return io.TextIOWrapper(member_handle).read()
+
+def bhavcopy_exists(zip_filename, csv_filename):
+    return os.path.exists(zip_filename) or os.path.exists(csv_filename)
+
+def parse_bse_bhavcopy(t_date):
+    zip_filename = 'bse_bhavcopy/' + get_bse_bhavcopy_filename(t_date)
     filename = get_bse_csv_bhavcopy_filename(t_date)
-    log('Processing csv: ' + filename)
+    log('Processing bhavcopy: %s', zip_filename)
 
-    if (not os.path.exists(filename)):
-        log('File ' + filename + ' not found. Skipping from CSV processing')
-        return
+    if (not bhavcopy_exists(zip_filename, filename)):
+        log('File %s not found. Skipping from CSV processing', zip_filename)
+        return None
 
-    scripts = get_scripts('bse_scripts.dat')
+    start = time.perf_counter()
+    day = {'rows': [], 'scripts': [], 'failed': False}
     try:
-        with open(filename, 'r') as f_handle:
-            reader = csv.DictReader(f_handle)
-            for row in reader:
-                scripts[row['SC_CODE']] = row['SC_NAME']
-                append_bse_script_data(row, t_date)
+        for code, name, scrip_type, open_price, high, low, close, volume in fast_csv.select_columns(bhavcopy_text(zip_filename, filename), BSE_COLUMNS):
+            day['scripts'].append((code, name))
+            if(scrip_type == 'Q'):
+                day['rows'].append((code, [str(t_date), open_price, high, low, close, volume]))
     except Exception as e:
-        log('Failed to process csv data', True)
-        log('Error: ' + e, True)
-    
-    write_scripts(scripts, 'bse_scripts.dat')
+        day['failed'] = True
+        log('Failed to process csv data', error=True)
+        log('Error: %s', e, error=True)
 
-def generate_nse_data(t_date):
+    # Parsing may run in a pool worker, the time travels with the day and is
+    # recorded by record_day.
+    day['seconds'] = time.perf_counter() - start
+    return day
+
+def parse_nse_bhavcopy(t_date):
+    zip_filename = 'nse_bhavcopy/' + get_nse_bhavcopy_filename(t_date)
     filename = get_nse_csv_bhavcopy_filename(t_date)
-    log('Processing csv: ' + filename)
+    log('Processing bhavcopy: %s', zip_filename)
 
-    if (not os.path.exists(filename)):
-        log('File ' + filename + ' not found. Skipping from CSV processing')
-        return
+    if (not bhavcopy_exists(zip_filename, filename)):
+        log('File %s not found. Skipping from CSV processing', zip_filename)
+        return None
 
+    start = time.perf_counter()
+    day = {'rows': [], 'failed': False}
+    try:
+        for symbol, series, open_price, high, low, close, volume in fast_csv.select_columns(bhavcopy_text(zip_filename, filename), NSE_COLUMNS):
+            if(series == 'EQ'):
+                day['rows'].append((symbol, [str(t_date), open_price, high, low, close, volume]))
+    except Exception as e:
+        day['failed'] = True
+        log('Failed to process csv data', error=True)
+        log('Error: %s', e, error=True)
+
+    day['seconds'] = time.perf_counter() - start
+    return day
+
+def record_day(exchange, t_date, day):
+    METRICS.add_time('ingest.parse_' + exchange, day['seconds'])
+    METRICS.set_value('ingest_rows_' + exchange, str(t_date), len(day['rows']))
+    METRICS.increment('ingest.rows_' + exchange, len(day['rows']))
+    if (day['failed']):
+        METRICS.increment('ingest.failed_' + exchange)
+
+def ohlcv_store_dir(exchange):
+    if (OHLCV_STORE != 'binary'):
+        return None
+    return 'data/' + exchange + '_ohlcv'
+
+def ohlcv_writer(exchange, on_flush = None):
+    # OHLCV_STORE=panel keeps the whole exchange in data/<exchange>_panel.*
+    # instead of one CSV (and store file) per scrip.
+    if (OHLCV_STORE == 'panel'):
+        return load_panel('data/' + exchange + '_panel', on_flush)
+
+    # Without the binary store only the CSVs get new rows, a store left from
+    # an earlier binary run would hide them from TA and is removed. The next
+    # binary run imports it again from the CSVs.
+    store_dir = ohlcv_store_dir(exchange)
+    if (store_dir is None and os.path.exists('data/' + exchange + '_ohlcv')):
+        log('Removing stale OHLCV store data/%s_ohlcv', exchange)
+        shutil.rmtree('data/' + exchange + '_ohlcv')
+    return ScripDataWriter('data/' + exchange, store_dir, on_flush=on_flush)
+
+def ingested_recorder(exchange, ingested):
+    # Passed as on_flush, so days are saved as ingested right after their
+    # rows are written. Rows of a flush cut off before that are skipped by
+    # the writers on the rerun, as they are not newer than what a scrip has.
+    def record(days):
+        ingested.update(days)
+        save_ingested_dates(exchange, ingested)
+    return record
+
+def ohlcv_source(datafile):
+    # Full TA runs read the binary store when a scrip has one, the CSVs stay
+    # as the export and as the input of the incremental update.
+    target_dir, filename = os.path.split(datafile)
+    path = ohlcv_store.store_path(target_dir + '_ohlcv', filename[:-4])
+    if (OHLCV_STORE == 'binary' and os.path.exists(path)):
+        return path
+    return datafile
+
+def store_bse_data(day, writer, registry):
+    for code, name in day['scripts']:
+        registry.update(code, name)
+    for code, row in day['rows']:
+        writer.append(code, row)
+
+def store_nse_data(day, writer):
+    for code, row in day['rows']:
+        writer.append(code, row)
+
+def ingested_filename(exchange, store = None):
+    # The panel keeps its own ingested dates, switching OHLCV_STORE leaves it
+    # with other days than the scrip files.
+    if ((store or OHLCV_STORE) == 'panel'):
+        return 'data/' + exchange + '_panel.ingested'
+    return 'data/' + exchange + '_ingested.dat'
+
+def load_ingested_dates(exchange, store = None):
     try:
-        with open(filename, 'r') as f_handle:
-            reader = csv.DictReader(f_handle)
-            for row in reader:
-                append_nse_script_data(row, t_date)
+        with open(ingested_filename(exchange, store), 'r') as f_handle:
+            return set(line.strip() for line in f_handle if line.strip())
     except Exception as e:
-        log('Failed to process csv data', True)
-        log('Error: ' + e, True)
+        return set()
 
-def append_bse_script_data(csv_row, t_date):
-    if(csv_row['SC_TYPE'] != 'Q'):
+def save_ingested_dates(exchange, ingested):
+    filename = ingested_filename(exchange)
+    with open(filename + '.tmp', 'w') as f_handle:
+        f_handle.writelines(t_date + '\n' for t_date in sorted(ingested))
+    os.replace(filename + '.tmp', filename)
+
+def bhavcopy_file(exchange, t_date):
+    zip_filename = bhavcopy_zip_filename(exchange, t_date)
+    return zip_filename if os.path.exists(zip_filename) else bhavcopy_csv_filename(exchange, t_date)
+
+def load_rejected(exchange):
+    try:
+        with open('data/' + exchange + '_rejected.json', 'r') as f_handle:
+            return json.load(f_handle)
+    except Exception as e:
+        return {}
+
+def reject_bhavcopy(exchange, t_date):
+    # A bhavcopy that fails to parse is remembered by its sha256 and removed,
+    # so the next download run fetches it again. While the exchange keeps
+    # serving the same bytes the day is left out of ingestion (and removed
+    # again), instead of counting as an older day that rebuilds the scrip
+    # files on every run.
+    filename = bhavcopy_file(exchange, t_date)
+    if (not os.path.exists(filename)):
         return
+    rejected = load_rejected(exchange)
+    rejected[str(t_date)] = file_digest(filename)[1]
+    with open('data/' + exchange + '_rejected.json.tmp', 'w') as f_handle:
+        json.dump(rejected, f_handle, indent=1, sort_keys=True)
+    os.replace('data/' + exchange + '_rejected.json.tmp', 'data/' + exchange + '_rejected.json')
+    log('Removing unreadable bhavcopy %s', filename, error=True)
+    os.remove(filename)
+
+def is_rejected(exchange, t_date, rejected):
+    return str(t_date) in rejected and file_digest(bhavcopy_file(exchange, t_date))[1] == rejected[str(t_date)]
+
+def panel_files(exchange):
+    return ['data/' + exchange + '_panel.ohlcv', 'data/' + exchange + '_panel.idx']
+
+def has_ohlcv_data(exchange):
+    if (OHLCV_STORE == 'panel'):
+        return os.path.exists(panel_files(exchange)[0])
+    target_dir = 'data/' + exchange
+    return os.path.exists(target_dir) and len(list_of_files(target_dir)) > 0
+
+def seed_panel(exchange):
+    # Switching an existing data directory to OHLCV_STORE=panel imports the
+    # scrip CSVs into a new panel, like ScripDataWriter.store does for the
+    # binary store, and takes over their ingested dates. Those are saved
+    # last, a seed that was interrupted starts over.
+    if (OHLCV_STORE != 'panel' or os.path.exists(ingested_filename(exchange))):
+        return
+    ingested = load_ingested_dates(exchange, 'csv')
+    if (len(ingested) == 0 or not os.path.exists('data/' + exchange)):
+        return
+
+    log('Seeding data/%s_panel from the scrip files in data/%s', exchange, exchange)
+    for filename in panel_files(exchange):
+        if (os.path.exists(filename)):
+            os.remove(filename)
+    OhlcvPanel('data/' + exchange + '_panel').import_csvs('data/' + exchange)
+    save_ingested_dates(exchange, ingested)
+
+def parses(exchange, t_date, parse_function):
+    day = parse_function(t_date)
+    if (day is not None and day['failed']):
+        reject_bhavcopy(exchange, t_date)
+        return False
+    return day is not None
+
+def ingest_plan(exchange, dates, parse_function):
+    # Only days with a bhavcopy on disk that are not in the scrip files yet
+    # get parsed. If one of them is older than data already ingested, the
+    # scrip files are rebuilt so that rows stay in date order, such days are
+    # parsed up front and only rebuild if they can be read. Scrip files
+    # without ingested dates (written before they were tracked) are rebuilt
+    # too, since it is unknown which days they hold.
+    seed_panel(exchange)
+    ingested = load_ingested_dates(exchange)
+    rejected = load_rejected(exchange)
+    new_dates = []
+    for t_date in dates:
+        if (str(t_date) not in ingested and bhavcopy_exists(bhavcopy_zip_filename(exchange, t_date), bhavcopy_csv_filename(exchange, t_date))):
+            if (is_rejected(exchange, t_date, rejected)):
+                reject_bhavcopy(exchange, t_date)
+            else:
+                new_dates.append(t_date)
+
+    if (len(new_dates) > 0 and len(ingested) > 0 and str(new_dates[0]) < max(ingested)):
+        last_date = max(ingested)
+        new_dates = [t_date for t_date in new_dates if str(t_date) > last_date or parses(exchange, t_date, parse_function)]
+
+    if (len(new_dates) == 0):
+        return new_dates, ingested
+    if (len(ingested) == 0):
+        if (not has_ohlcv_data(exchange)):
+            return new_dates, ingested
+        log('No ingested %s dates recorded, rebuilding data/%s', exchange, exchange)
+    elif (str(new_dates[0]) > max(ingested)):
+        return new_dates, ingested
+    else:
+        log('Older %s bhavcopies found, rebuilding data/%s', exchange, exchange)
 
-    with open('data/bse/'+csv_row['SC_CODE']+'.csv', 'a') as f_handle:
-        writer = csv.writer(f_handle)
-        writer.writerow([str(t_date), csv_row['OPEN'], csv_row['HIGH'], csv_row['LOW'], csv_row['CLOSE'], csv_row['NO_OF_SHRS']])
+    save_ingested_dates(exchange, set())
+    if (OHLCV_STORE == 'panel'):
+        for filename in panel_files(exchange):
+            if (os.path.exists(filename)):
+                os.remove(filename)
+    else:
+        for target_dir in ('data/' + exchange, 'data/' + exchange + '_ohlcv'):
+            if (os.path.exists(target_dir)):
+                for filename in list_of_files(target_dir):
+                    os.remove(target_dir + '/' + filename)
+
+    all_dates = set(new_dates)
+    for t_date in ingested:
+        all_dates.add(date.fromisoformat(t_date))
+    return sorted(all_dates), set()
 
-def append_nse_script_data(csv_row, t_date):
-    if(csv_row['SERIES'] != 'EQ'):
+def generate_bse_data(t_date):
+    seed_panel('bse')
+    ingested = load_ingested_dates('bse')
+    if (str(t_date) in ingested):
+        log('BSE bhavcopy for %s already processed. Skipping from CSV processing', t_date)
         return
 
-    with open('data/nse/'+csv_row['SYMBOL']+'.csv', 'a') as f_handle:
-        writer = csv.writer(f_handle)
-        writer.writerow([str(t_date), csv_row['OPEN'], csv_row['HIGH'], csv_row['LOW'], csv_row['CLOSE'], csv_row['TOTTRDQTY']])
-    
-def write_scripts(scripts, script_file):
-    fields = ['code', 'name']
-    log('Updating bse script details')
-    with open('data/'+script_file, 'w') as f_handle:
-        writer = csv.DictWriter(f_handle, fields)
-        for key in scripts:
-            writer.writerow({'code': key, 'name': scripts[key]})
-
-def get_scripts(script_file):
-    scripts = {}
-    try:
-        with open('data/'+script_file, 'r') as f_handle:
-            reader = csv.DictReader(f_handle, ['code', 'name'])
-            for row in reader:
-                scripts[row['code']] = row['name']
-        return scripts
-    except Exception as e:
-        return scripts
+    day = parse_bse_bhavcopy(t_date)
+    if (day is None):
+        return
+    record_day('bse', t_date, day)
+    if (day['failed']):
+        reject_bhavcopy('bse', t_date)
+        return
+
+    registry = load_registry('bse_scripts.dat')
+    with ohlcv_writer('bse', ingested_recorder('bse', ingested)) as writer:
+        store_bse_data(day, writer, registry)
+        writer.end_day(str(t_date))
+
+    if (registry.changed):
+        log('Updating bse script details')
+        registry.save()
+
+def generate_nse_data(t_date):
+    seed_panel('nse')
+    ingested = load_ingested_dates('nse')
+    if (str(t_date) in ingested):
+        log('NSE bhavcopy for %s already processed. Skipping from CSV processing', t_date)
+        return
+
+    day = parse_nse_bhavcopy(t_date)
+    if (day is None):
+        return
+    record_day('nse', t_date, day)
+    if (day['failed']):
+        reject_bhavcopy('nse', t_date)
+        return
+
+    with ohlcv_writer('nse', ingested_recorder('nse', ingested)) as writer:
+        store_nse_data(day, writer)
+        writer.end_day(str(t_date))
+
+def bhavcopy_dates():
+    itr_date = return_init_date()
+    curr_date = date.today()
+    dates = []
+
+    while curr_date >= itr_date:
+        itr_date += relativedelta(days=+1)
+        dates.append(itr_date)
+
+    return dates
+
+def parse_bhavcopies(parse_function, dates):
+    if (INGEST_WORKERS <= 1):
+        for t_date in dates:
+            yield parse_function(t_date)
+        return
+
+    # Days are parsed in parallel but map() hands the results back in date
+    # order, so every scrip file still gets its rows in date order.
+    with concurrent.futures.ProcessPoolExecutor(INGEST_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for day in executor.map(parse_function, dates, chunksize=INGEST_CHUNK_SIZE):
+            yield day
 
 def process_data():
     t1 = threading.Thread(target=compute_bse_data)
@@ -302,44 +686,65 @@ def process_data():
     t1.join()
     t2.join()
 
+@timed('stage.process_bse_data')
+@profiled('process_bse_data')
 def process_bse_data():
-    itr_date = return_init_date()
-    curr_date = date.today()
-
-    log('Process BSE bhavcopy data: Starting')
-
-    while curr_date >= itr_date:
-        itr_date += relativedelta(days=+1)
-        generate_bse_data(itr_date)
-
-    log('Process BSE bhavcopy data: Completed')
-
+    log_queue.info('Process BSE bhavcopy data: Starting')
+
+    dates, ingested = ingest_plan('bse', bhavcopy_dates(), parse_bse_bhavcopy)
+    registry = load_registry('bse_scripts.dat')
+    with ohlcv_writer('bse', ingested_recorder('bse', ingested)) as writer:
+        for t_date, day in zip(dates, parse_bhavcopies(parse_bse_bhavcopy, dates)):
+            if (day is not None):
+                record_day('bse', t_date, day)
+            # A day that failed to parse is left out entirely, it is not
+            # marked as ingested and its bhavcopy is rejected.
+            if (day is not None and day['failed']):
+                reject_bhavcopy('bse', t_date)
+            elif (day is not None):
+                store_bse_data(day, writer, registry)
+                writer.end_day(str(t_date))
+
+    if (registry.changed):
+        log('Updating bse script details')
+        registry.save()
+
+    log_queue.info('Process BSE bhavcopy data: Completed')
+
+@timed('stage.process_nse_data')
+@profiled('process_nse_data')
 def process_nse_data():
-    itr_date = return_init_date()
-    curr_date = date.today()
+    log_queue.info('Process NSE bhavcopy data: Starting')
 
-    log('Process NSE bhavcopy data: Starting')
+    dates, ingested = ingest_plan('nse', bhavcopy_dates(), parse_nse_bhavcopy)
+    with ohlcv_writer('nse', ingested_recorder('nse', ingested)) as writer:
+        for t_date, day in zip(dates, parse_bhavcopies(parse_nse_bhavcopy, dates)):
+            if (day is not None):
+                record_day('nse', t_date, day)
+            if (day is not None and day['failed']):
+                reject_bhavcopy('nse', t_date)
+            elif (day is not None):
+                store_nse_data(day, writer)
+                writer.end_day(str(t_date))
 
-    while curr_date >= itr_date:
-        itr_date += relativedelta(days=+1)
-        generate_nse_data(itr_date)
-
-    log('Process NSE bhavcopy data: Completed')
+    log_queue.info('Process NSE bhavcopy data: Completed')
 
 def compute_bse_data():
-    process_bse_bhavcopy()
     process_bse_data()
     process_ta('data/bse', 'data/ta_bse')
 
 def compute_nse_data():
-    process_nse_bhavcopy()
     process_nse_data()
     process_ta('data/nse', 'data/ta_nse')
 
 def init():
-    create_data_dir()
+    if (INIT_FRESH != False):
+        create_data_dir()
+    else:
+        ensure_data_dir()
     download_historic_data()
     process_data()
+    emit_metrics()
 
 def update_bhavcopy(t_date):
     t1 = threading.Thread(target=update_bse_bhavcopy, args=(t_date,))
@@ -350,32 +755,132 @@ def update_bhavcopy(t_date):
     t2.join()
 
 def update_nse_bhavcopy(t_date):
-    download_nse_bhavcopy(t_date)
+    start = time.perf_counter()
+    status = download_nse_bhavcopy(t_date)
+    record_download(get_nse_bhavcopy_url(t_date), status, time.perf_counter() - start)
     bhavcopy_file = get_nse_bhavcopy_filename(t_date)
-    process_nse_bhavcopy()
     generate_nse_data(t_date)
-    process_ta('data/nse', 'data/ta_nse')
+    update_ta('data/nse', 'data/ta_nse', 'data/ta_state_nse')
 
 def update_bse_bhavcopy(t_date):
-    download_bse_bhavcopy(t_date)
+    start = time.perf_counter()
+    status = download_bse_bhavcopy(t_date)
+    record_download(get_bse_bhavcopy_url(t_date), status, time.perf_counter() - start)
     bhavcopy_file = get_bse_bhavcopy_filename(t_date)
-    process_bse_bhavcopy()
     generate_bse_data(t_date)
-    process_ta('data/bse', 'data/ta_bse')
+    update_ta('data/bse', 'data/ta_bse', 'data/ta_state_bse')
 
 def fetch_and_process_today_data():
     t_date = date.today()
     update_bhavcopy(t_date)
+    emit_metrics()
+
+def emit_metrics():
+    # The full summary, with per URL, per day and per scrip values, goes to
+    # METRICS_FILE, the log only gets the stage timings and counters.
+    METRICS.save()
+    summary = METRICS.summary()
+    log_queue.info('Run metrics: %s', json.dumps({'seconds': summary['seconds'], 'timings': summary['timings'], 'counters': summary['counters']}))
+
+def ta_jobs(target_dir, destination_dir):
+    jobs = []
+    for file_to_process in list_of_files(target_dir):
+        destination_file = file_to_process[:-4] + "_TA.csv"
+        log('Generating Technical Analysis data for %s/%s in %s/%s', target_dir, file_to_process, destination_dir, destination_file)
+        jobs.append((target_dir+'/'+file_to_process, destination_dir+'/'+destination_file))
+    return jobs
+
+def chunks(items, size):
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def ta_executor():
+    if (TA_EXECUTOR == 'thread'):
+        return concurrent.futures.ThreadPoolExecutor(80)
+
+    # Spawned (not forked) workers stay safe while process_data and
+    # update_bhavcopy run both exchanges in threads.
+    return concurrent.futures.ProcessPoolExecutor(TA_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+def market_mode():
+    # TA_MODE=market computes each batch of scrips in one pass over bar x scrip
+    # matrices, it needs numpy and the default indicator set and falls back to
+    # per-scrip TA otherwise.
+    return TA_MODE == 'market' and ta_market is not None and not ta.custom_spec()
+
+def run_ta_batches(batch_function, jobs, target_dir, chunk_size = TA_CHUNK_SIZE):
+    log_queue.info('Generating Technical Analysis data for %d files in %s: Starting', len(jobs), target_dir)
+
+    # Workers write the TA files themselves and only report a count, their
+    # metrics and sampled profiles back, so no series data is pickled between
+    # processes.
+    processed = 0
+    with METRICS.timer('stage.ta_' + os.path.basename(target_dir)), ta_executor() as executor:
+        futures = [executor.submit(batch_function, batch) for batch in chunks(jobs, chunk_size)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                processed_count, metrics, profile = future.result()
+                processed += processed_count
+                METRICS.merge(metrics)
+                profiling.add(profile)
+            except Exception as e:
+                METRICS.increment('ta.failed_batches')
+                log('Technical Analysis batch failed for %s: %s', target_dir, e, error=True)
+
+    log_queue.info('Generating Technical Analysis data for %d files in %s: Completed', processed, target_dir)
 
 def process_ta(target_dir, destination_dir):
-    with concurrent.futures.ThreadPoolExecutor(80) as executor:
-        futures = []
-        for file_to_process in list_of_files(target_dir):
-            destination_file = file_to_process[:-4] + "_TA.csv"
-            log('Generating Technical Analysis data for ' + target_dir + '/' + file_to_process + ' in ' + destination_dir + '/' + destination_file)
-            futures.append(executor.submit(ta.initialize_ta_data, datafile=target_dir+'/'+file_to_process, destination_file=destination_dir+'/'+destination_file))
-    
+    with profiling.stage('process_ta_' + os.path.basename(target_dir)):
+        if (OHLCV_STORE == 'panel'):
+            process_ta_panel(target_dir + '_panel', destination_dir)
+            return
+
+        # The manifest is keyed by the CSVs in every mode, the source is only
+        # swapped for the binary store once the changed jobs are known.
+        manifest = load_ta_manifest(destination_dir, ta.plan_signature())
+        jobs = changed_ta_jobs(manifest, ta_jobs(target_dir, destination_dir), target_dir)
+        jobs = [(ohlcv_source(datafile), destination_file) for datafile, destination_file in jobs]
+        if (market_mode()):
+            run_ta_batches(ta_market.initialize_ta_batch, jobs, target_dir, TA_MARKET_CHUNK_SIZE)
+        elif (TA_MODE == 'stream'):
+            # One bar at a time with bounded memory per scrip.
+            run_ta_batches(ta_stream.initialize_ta_batch, jobs, target_dir)
+        else:
+            run_ta_batches(ta.initialize_ta_batch, jobs, target_dir)
+        manifest.record()
+        manifest.save()
+
+def changed_ta_jobs(manifest, jobs, target_dir):
+    # Only scrips whose source changed since their TA file was written are
+    # recomputed, TA_FORCE recomputes all of them.
+    changed_jobs = manifest.changed(jobs, TA_FORCE != False)
+    log('Skipping Technical Analysis for %d unchanged files in %s', len(jobs) - len(changed_jobs), target_dir)
+    return changed_jobs
+
+def process_ta_panel(panel, destination_dir):
+    jobs = [(panel, code, destination_dir + '/' + code + '_TA.csv') for code in panel_codes(panel)]
+    if (market_mode()):
+        run_ta_batches(ta_market.initialize_ta_panel_batch, jobs, panel, TA_MARKET_CHUNK_SIZE)
+    else:
+        run_ta_batches(ta.initialize_ta_panel_batch, jobs, panel)
+
+def process_ta_incremental(target_dir, destination_dir, state_dir):
+    with profiling.stage('process_ta_incremental_' + os.path.basename(target_dir)):
+        os.makedirs(state_dir, exist_ok=True)
+        manifest = load_ta_manifest(destination_dir, ta.plan_signature())
+        jobs = []
+        for datafile, destination_file in ta_jobs(target_dir, destination_dir):
+            jobs.append((datafile, destination_file, state_dir + '/' + os.path.basename(destination_file)[:-4] + '.json'))
+        run_ta_batches(ta_incremental.update_ta_batch, changed_ta_jobs(manifest, jobs, target_dir), target_dir)
+        manifest.record()
+        manifest.save()
+
+def update_ta(target_dir, destination_dir, state_dir):
+    # The incremental update reads the per-scrip CSVs and computes the default
+    # indicator set, a panel or a custom TA_SPEC is always processed in full.
+    if (TA_FULL_UPDATE != False or OHLCV_STORE == 'panel' or ta.custom_spec()):
+        process_ta(target_dir, destination_dir)
+    else:
+        process_ta_incremental(target_dir, destination_dir, state_dir)
 
-    
 if __name__ == '__main__':
     init()
\ No newline at end of file
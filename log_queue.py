@@ -0,0 +1,108 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+
+# Logging through a queue. Callers only compare the level and queue the
+# message with its arguments, the message % args formatting and the writes
+# happen on a background thread, which writes everything queued so far with
+# one call. Download threads and TA workers never wait on stdout, and a
+# disabled level costs a single comparison. LOG_LEVEL picks the level,
+# LOG_DEV alone still turns on everything.
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'ERROR': ERROR}
+
+LOG_LEVEL = LEVELS.get(os.getenv('LOG_LEVEL', 'DEBUG' if os.getenv('LOG_DEV', False) != False else 'ERROR').upper(), ERROR)
+
+
+def format_message(message, args):
+    if (len(args) == 0):
+        return message
+    try:
+        return message % args
+    except Exception as e:
+        return message + ' ' + repr(args)
+
+
+class LogWriter(object):
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, message, args):
+        if (self.thread is None):
+            self.start()
+        self.queue.put((message, args))
+
+    def start(self):
+        with self.lock:
+            if (self.thread is None):
+                self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = [format_message(*item) for item in items if item is not None]
+            try:
+                if (len(lines) > 0):
+                    sys.stdout.write('\n'.join(lines) + '\n')
+                    sys.stdout.flush()
+            except OSError as e:
+                # A closed stdout (e.g. a pipe into head) drops the messages
+                # instead of stopping the writer.
+                pass
+            if (None in items):
+                return
+
+    def flush(self):
+        # Writes out everything queued so far, the next message starts a new
+        # writer thread.
+        with self.lock:
+            if (self.thread is not None):
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+
+WRITER = LogWriter()
+atexit.register(WRITER.flush)
+
+
+def enabled(level):
+    return level >= LOG_LEVEL
+
+
+def log(level, message, *args):
+    if (level >= LOG_LEVEL):
+        WRITER.put(message, args)
+
+
+def debug(message, *args):
+    if (DEBUG >= LOG_LEVEL):
+        WRITER.put(message, args)
+
+
+def info(message, *args):
+    if (INFO >= LOG_LEVEL):
+        WRITER.put(message, args)
+
+
+def error(message, *args):
+    if (ERROR >= LOG_LEVEL):
+        WRITER.put(message, args)
+
+
+def flush():
+    WRITER.flush()
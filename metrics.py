@@ -0,0 +1,118 @@
+import functools
+import json
+import os
+import threading
+import time
+import profiling
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.json')
+
+
+class Metrics(object):
+    # Timings (count / total / max seconds), counters and keyed values such
+    # as the latency of every download URL, collected during one run. Pool
+    # workers collect into their own copy and hand it back with each batch
+    # result (see batch_result), the parent merges it into its own.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now()
+            self.timings = {}
+            self.counters = {}
+            self.values = {}
+
+    def add_time(self, name, seconds, count = 1):
+        with self.lock:
+            if (name not in self.timings):
+                self.timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+            timing = self.timings[name]
+            timing['count'] += count
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def increment(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_value(self, group, key, value):
+        with self.lock:
+            if (group not in self.values):
+                self.values[group] = {}
+            self.values[group][key] = value
+
+    def drain(self):
+        with self.lock:
+            snapshot = {'timings': self.timings, 'counters': self.counters, 'values': self.values}
+            self.timings = {}
+            self.counters = {}
+            self.values = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, timing in snapshot['timings'].items():
+            with self.lock:
+                if (name not in self.timings):
+                    self.timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+                self.timings[name]['count'] += timing['count']
+                self.timings[name]['total'] += timing['total']
+                self.timings[name]['max'] = max(self.timings[name]['max'], timing['max'])
+        for name, value in snapshot['counters'].items():
+            self.increment(name, value)
+        for group, values in snapshot['values'].items():
+            for key, value in values.items():
+                self.set_value(group, key, value)
+
+    def summary(self):
+        with self.lock:
+            timings = {}
+            for name in sorted(self.timings):
+                timing = self.timings[name]
+                timings[name] = {'count': timing['count'], 'total': round(timing['total'], 6),
+                                 'mean': round(timing['total'] / timing['count'], 6) if timing['count'] else 0,
+                                 'max': round(timing['max'], 6)}
+            return {
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round((datetime.now() - self.started).total_seconds(), 3),
+                'timings': timings,
+                'counters': dict(sorted(self.counters.items())),
+                'values': {group: dict(values) for group, values in self.values.items()}
+            }
+
+    def save(self, path = METRICS_FILE):
+        with open(path + '.tmp', 'w') as f_handle:
+            json.dump(self.summary(), f_handle, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+METRICS = Metrics()
+
+
+def batch_result(processed):
+    # TA batch functions return this instead of a bare count, so the per-scrip
+    # metrics and sampled profiles of process pool workers reach the parent.
+    return processed, METRICS.drain(), profiling.drain()
+
+
+def timed(name):
+    # Decorator recording every call of a function under the timing name.
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,206 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+import ohlcv_store
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Market-wide OHLCV panel of one exchange, kept in two files instead of one
+# CSV per scrip. <path>.ohlcv holds fixed-width records (scrip id, yyyymmdd
+# date, open, high, low, close, volume) appended a day at a time, so it is
+# ordered by date and then by scrip. <path>.idx starts with a JSON line that
+# lists the scrip codes (a code's position is its id), the row count of each
+# scrip and the number of records it covers, followed by the record numbers
+# of every scrip as int64, one scrip after the other. Records past the
+# indexed count come from an interrupted write and are dropped on append.
+# A panel seeded from existing scrip CSVs (import_csvs) starts with their
+# histories one scrip after the other, readers only go through the index.
+
+RECORD = struct.Struct('<qqddddq')
+RECORD_DTYPE = [('scrip', '<i8'), ('date', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'), ('volume', '<i8')]
+MAX_BUFFERED_ROWS = 500000
+
+
+def read_index(f_handle):
+    header = json.loads(f_handle.readline())
+    starts = []
+    start = 0
+    for count in header['counts']:
+        starts.append(start)
+        start += count
+    return header, starts
+
+
+class OhlcvPanel(object):
+    # Writer side of the panel with the same append()/end_day()/close()
+    # interface as ScripDataWriter, so ingestion can store into either one.
+
+    def __init__(self, path, max_buffered_rows = MAX_BUFFERED_ROWS, on_flush = None):
+        self.path = path
+        self.max_buffered_rows = max_buffered_rows
+        self.on_flush = on_flush
+        self.days = []
+        self.codes = []
+        self.ids = {}
+        self.offsets = []
+        self.rows = 0
+        self.last_dates = {}
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is None):
+            self.close()
+        else:
+            self.buffer = []
+            self.days = []
+
+    def load(self):
+        self.codes = []
+        self.offsets = []
+        self.rows = 0
+        try:
+            with open(self.path + '.idx', 'rb') as f_handle:
+                header, starts = read_index(f_handle)
+                offsets = ohlcv_store.from_bytes('q', f_handle.read())
+            self.rows = header['rows']
+            self.codes = header['codes']
+            for start, count in zip(starts, header['counts']):
+                self.offsets.append(offsets[start:start + count])
+        except FileNotFoundError as e:
+            pass
+
+        self.ids = {code: scrip for scrip, code in enumerate(self.codes)}
+        return self
+
+    def append(self, code, row):
+        self.buffer.append((code, row))
+
+    def end_day(self, day):
+        self.days.append(day)
+        if (len(self.buffer) >= self.max_buffered_rows):
+            self.flush()
+
+    def scrip_id(self, code):
+        if (code not in self.ids):
+            self.ids[code] = len(self.codes)
+            self.codes.append(code)
+            self.offsets.append(array('q'))
+        return self.ids[code]
+
+    def flush(self):
+        days = self.days
+        self.days = []
+        if (len(self.buffer) > 0):
+            self.write_buffer()
+        if (self.on_flush is not None and len(days) > 0):
+            self.on_flush(days)
+
+    def last_date(self, scrip, f_handle):
+        # Date of the last indexed record of a scrip, rows up to it were
+        # written by a flush that was cut off before its days were recorded.
+        if (scrip not in self.last_dates):
+            self.last_dates[scrip] = 0
+            if (len(self.offsets[scrip]) > 0):
+                f_handle.seek(self.offsets[scrip][-1] * RECORD.size)
+                self.last_dates[scrip] = RECORD.unpack(f_handle.read(RECORD.size))[1]
+        return self.last_dates[scrip]
+
+    def write_buffer(self):
+        columns = ohlcv_store.convert_rows([row for code, row in self.buffer])
+        records = bytearray()
+        added = 0
+        panel_file = self.path + '.ohlcv'
+        with open(panel_file, 'r+b' if os.path.exists(panel_file) else 'w+b') as f_handle:
+            for i, (code, row) in enumerate(self.buffer):
+                scrip = self.scrip_id(code)
+                if (columns['date'][i] <= self.last_date(scrip, f_handle)):
+                    continue
+                self.last_dates[scrip] = columns['date'][i]
+                self.offsets[scrip].append(self.rows + added)
+                records += RECORD.pack(scrip, columns['date'][i], columns['open'][i], columns['high'][i], columns['low'][i], columns['close'][i], columns['volume'][i])
+                added += 1
+
+            f_handle.truncate(self.rows * RECORD.size)
+            f_handle.seek(self.rows * RECORD.size)
+            f_handle.write(records)
+
+        self.rows += added
+        self.buffer = []
+        self.save_index()
+
+    def save_index(self):
+        header = {'rows': self.rows, 'codes': self.codes, 'counts': [len(offsets) for offsets in self.offsets]}
+        with open(self.path + '.idx.tmp', 'wb') as f_handle:
+            f_handle.write(json.dumps(header).encode() + b'\n')
+            for offsets in self.offsets:
+                f_handle.write(ohlcv_store.to_bytes(offsets))
+        os.replace(self.path + '.idx.tmp', self.path + '.idx')
+
+    def import_csvs(self, target_dir):
+        for filename in sorted(os.listdir(target_dir)):
+            if (not filename.endswith('.csv')):
+                continue
+            with open(os.path.join(target_dir, filename), 'r') as f_handle:
+                for line in f_handle:
+                    if (line.strip()):
+                        self.buffer.append((filename[:-4], line.rstrip('\r\n').split(',')))
+            if (len(self.buffer) >= self.max_buffered_rows):
+                self.write_buffer()
+        if (len(self.buffer) > 0):
+            self.write_buffer()
+
+    def close(self):
+        self.flush()
+
+
+def load_panel(path, on_flush = None):
+    return OhlcvPanel(path, on_flush=on_flush).load()
+
+
+def panel_codes(path):
+    try:
+        with open(path + '.idx', 'rb') as f_handle:
+            return json.loads(f_handle.readline())['codes']
+    except FileNotFoundError as e:
+        return []
+
+
+def read_scrips(path, codes, use_numpy = False):
+    # Yields (code, columns) for the given scrips. Only their slices of the
+    # index are read, and the records are gathered from a memory map of the
+    # panel, so a batch of scrips costs one pass over the pages it touches.
+    with open(path + '.idx', 'rb') as f_handle:
+        header, starts = read_index(f_handle)
+        base = f_handle.tell()
+        ids = {code: scrip for scrip, code in enumerate(header['codes'])}
+        offsets = {}
+        for code in codes:
+            scrip = ids[code]
+            f_handle.seek(base + starts[scrip] * 8)
+            offsets[code] = ohlcv_store.from_bytes('q', f_handle.read(header['counts'][scrip] * 8))
+
+    with open(path + '.ohlcv', 'rb') as f_handle:
+        content = mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if (use_numpy and np is not None):
+        records = np.frombuffer(content, dtype=RECORD_DTYPE, count=header['rows'])
+        for code in codes:
+            rows = records[np.asarray(offsets[code])]
+            yield code, {field: np.ascontiguousarray(rows[field]) for field in ohlcv_store.FIELDS}
+        return
+
+    for code in codes:
+        columns = {field: array(ohlcv_store.TYPECODES[field]) for field in ohlcv_store.FIELDS}
+        for row in offsets[code]:
+            record = RECORD.unpack_from(content, row * RECORD.size)
+            for field, value in zip(ohlcv_store.FIELDS, record[1:]):
+                columns[field].append(value)
+        yield code, columns
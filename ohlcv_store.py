@@ -0,0 +1,175 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Binary per-scrip OHLCV history kept next to the CSVs, for example
+# data/bse_ohlcv/<code>.ohlcv. A 24 byte header (magic, row count, capacity)
+# is followed by one fixed-width little-endian column per field, each sized
+# for `capacity` rows: dates as yyyymmdd int64, OHLC as float64 and volume as
+# int64. New days are written into the free tail of every column, and the
+# file is rewritten with twice the capacity once it is full, so readers can
+# always map each column as one contiguous array.
+
+MAGIC = b'OHLCV\x00\x00\x01'
+HEADER = struct.Struct('<8sqq')
+EXTENSION = '.ohlcv'
+FIELDS = ['date', 'open', 'high', 'low', 'close', 'volume']
+TYPECODES = {'date': 'q', 'open': 'd', 'high': 'd', 'low': 'd', 'close': 'd', 'volume': 'q'}
+ITEM_SIZE = 8
+MIN_CAPACITY = 64
+
+
+def store_path(store_dir, code):
+    return store_dir + '/' + code + EXTENSION
+
+
+def date_to_int(value):
+    return int(value[0:4] + value[5:7] + value[8:10])
+
+
+def int_to_date(value):
+    return '%04d-%02d-%02d' % (value // 10000, value // 100 % 100, value % 100)
+
+
+def dates(values):
+    return [int_to_date(value) for value in values.tolist()]
+
+
+def column_offset(capacity, index, count = 0):
+    return HEADER.size + (index * capacity + count) * ITEM_SIZE
+
+
+def to_bytes(values):
+    if (sys.byteorder != 'little'):
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_bytes(typecode, content):
+    values = array(typecode)
+    values.frombytes(content)
+    if (sys.byteorder != 'little'):
+        values.byteswap()
+    return values
+
+
+def read_header(content, path):
+    magic, count, capacity = HEADER.unpack_from(content)
+    if (magic != MAGIC):
+        raise Exception(path + ' is not an OHLCV store file')
+    return count, capacity
+
+
+def convert_rows(rows):
+    # Prices are rounded exactly like ta.i2f so the store holds the same
+    # values the CSV reader would produce.
+    columns = {field: array(TYPECODES[field]) for field in FIELDS}
+    for row in rows:
+        columns['date'].append(date_to_int(row[0]))
+        columns['open'].append(round(float(row[1]), 4))
+        columns['high'].append(round(float(row[2]), 4))
+        columns['low'].append(round(float(row[3]), 4))
+        columns['close'].append(round(float(row[4]), 4))
+        columns['volume'].append(int(row[5]))
+    return columns
+
+
+def read_columns(path, zero_copy = False):
+    # With zero_copy (numpy required) every column is a read-only numpy view
+    # over a memory map of the file, otherwise columns are copied into
+    # array.array without any text parsing.
+    with open(path, 'rb') as f_handle:
+        if (zero_copy and np is not None):
+            content = mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            content = f_handle.read()
+
+    count, capacity = read_header(content, path)
+    columns = {}
+    for index, field in enumerate(FIELDS):
+        offset = column_offset(capacity, index)
+        if (isinstance(content, mmap.mmap)):
+            columns[field] = np.frombuffer(content, dtype='<' + TYPECODES[field], count=count, offset=offset)
+        else:
+            columns[field] = from_bytes(TYPECODES[field], content[offset:offset + count * ITEM_SIZE])
+    return columns
+
+
+def iter_rows(path, chunk_rows = 4096):
+    # Rows in date order, read a chunk of every column at a time.
+    with open(path, 'rb') as f_handle:
+        count, capacity = read_header(f_handle.read(HEADER.size), path)
+        for start in range(0, count, chunk_rows):
+            size = min(chunk_rows, count - start)
+            columns = []
+            for index, field in enumerate(FIELDS):
+                f_handle.seek(column_offset(capacity, index, start))
+                columns.append(from_bytes(TYPECODES[field], f_handle.read(size * ITEM_SIZE)).tolist())
+            columns[0] = [int_to_date(value) for value in columns[0]]
+            for row in zip(*columns):
+                yield row
+
+
+def write_columns(path, columns, capacity):
+    count = len(columns['date'])
+    with open(path + '.tmp', 'wb') as f_handle:
+        f_handle.write(HEADER.pack(MAGIC, count, capacity))
+        for field in FIELDS:
+            f_handle.write(to_bytes(columns[field]))
+            f_handle.write(bytes((capacity - count) * ITEM_SIZE))
+    os.replace(path + '.tmp', path)
+
+
+def last_date(f_handle, count, capacity):
+    if (count == 0):
+        return 0
+    f_handle.seek(column_offset(capacity, 0, count - 1))
+    return from_bytes('q', f_handle.read(ITEM_SIZE))[0]
+
+
+def append_rows(path, rows):
+    if (not os.path.exists(path)):
+        new_columns = convert_rows(rows)
+        write_columns(path, new_columns, max(MIN_CAPACITY, len(new_columns['date'])))
+        return
+
+    with open(path, 'r+b') as f_handle:
+        count, capacity = read_header(f_handle.read(HEADER.size), path)
+        # Rows up to the last stored date are already in the file, written
+        # by a flush that was cut off before its days were recorded.
+        stored = last_date(f_handle, count, capacity)
+        new_columns = convert_rows([row for row in rows if date_to_int(row[0]) > stored])
+        added = len(new_columns['date'])
+        if (added == 0):
+            return
+        if (count + added <= capacity):
+            for index, field in enumerate(FIELDS):
+                f_handle.seek(column_offset(capacity, index, count))
+                f_handle.write(to_bytes(new_columns[field]))
+            # The row count goes in last, a crash before it leaves the
+            # previous rows intact.
+            f_handle.flush()
+            f_handle.seek(0)
+            f_handle.write(HEADER.pack(MAGIC, count + added, capacity))
+            return
+
+    columns = read_columns(path)
+    for field in FIELDS:
+        columns[field].extend(new_columns[field])
+    write_columns(path, columns, max(2 * capacity, count + added))
+
+
+def import_csv(path, csv_file):
+    with open(csv_file, 'r') as f_handle:
+        rows = [line.rstrip('\r\n').split(',') for line in f_handle if line.strip()]
+    if (os.path.exists(path)):
+        os.remove(path)
+    append_rows(path, rows)
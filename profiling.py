@@ -0,0 +1,136 @@
+import cProfile
+import functools
+import os
+import pstats
+import threading
+import zlib
+from contextlib import contextmanager
+import log_queue
+
+# Opt-in profiling of the pipeline stages, PROFILE=1 turns it on. Every stage
+# writes <PROFILE_DIR>/<stage>.prof (for pstats / snakeviz) and <stage>.txt
+# with the PROFILE_TOP hottest functions by cumulative time. TA runs in pool
+# workers, there only a PROFILE_SAMPLE share of the scrips is profiled,
+# chosen by a hash of the scrip so every run samples the same ones, and the
+# worker profiles come back with the batch results to be added to the
+# process_ta_* stage.
+
+PROFILE = os.getenv('PROFILE', False)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 30))
+PROFILE_SAMPLE = float(os.getenv('PROFILE_SAMPLE', 0.1))
+
+LOCAL = threading.local()
+
+
+def enabled():
+    return PROFILE != False
+
+
+def sampled(name):
+    return zlib.crc32(name.encode()) % 10000 < PROFILE_SAMPLE * 10000
+
+
+class ProfileStats(object):
+    # pstats.Stats accepts anything with create_stats() and a stats dict,
+    # this carries the stats of a worker profile back to the parent.
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def start_profiler():
+    # Only one profiler can be active at a time on Python 3.12+, a stage
+    # running alongside another one (process_data runs both exchanges in
+    # threads) then goes without the parent profile.
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        log_queue.info('Profiler not started: %s', e)
+        return None
+    return profiler
+
+
+def save(name, profiles):
+    profiles = [profile for profile in profiles if profile is not None]
+    if (len(profiles) == 0):
+        return
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(path + '.prof')
+    with open(path + '.txt', 'w') as f_handle:
+        stats.stream = f_handle
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+    log_queue.info('Profile of %s written to %s.prof', name, path)
+
+
+@contextmanager
+def stage(name):
+    if (not enabled()):
+        yield
+        return
+
+    LOCAL.worker_profiles = []
+    profiler = start_profiler()
+    try:
+        yield
+    finally:
+        if (profiler is not None):
+            profiler.disable()
+        worker_profiles = LOCAL.worker_profiles
+        LOCAL.worker_profiles = None
+        save(name, [profiler] + worker_profiles)
+
+
+def profiled(name):
+    # Decorator running every call of a function as the profiled stage name.
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(profile):
+    # Adds a worker profile (see drain) to the stage running in this thread.
+    if (profile is not None and getattr(LOCAL, 'worker_profiles', None) is not None):
+        LOCAL.worker_profiles.append(profile)
+
+
+@contextmanager
+def scrip(name):
+    # Profiles the block if the scrip is sampled, into the profile of this
+    # worker thread that drain hands back.
+    if (not enabled() or not sampled(name)):
+        yield
+        return
+
+    if (getattr(LOCAL, 'scrip_profiler', None) is None):
+        LOCAL.scrip_profiler = cProfile.Profile()
+    profiler = LOCAL.scrip_profiler
+    try:
+        profiler.enable()
+    except ValueError as e:
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+
+def drain():
+    profiler = getattr(LOCAL, 'scrip_profiler', None)
+    if (profiler is None):
+        return None
+    LOCAL.scrip_profiler = None
+    profiler.create_stats()
+    return ProfileStats(profiler.stats)
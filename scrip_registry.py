@@ -0,0 +1,61 @@
+import csv
+import os
+
+REGISTRY_FIELDS = ['code', 'name']
+
+
+class ScripRegistry(object):
+    # In-memory view of a scrip master file such as data/bse_scripts.dat.
+    # It is loaded once, updated while bhavcopies are processed and written
+    # back once with an atomic replace, so readers never see a partial file.
+
+    def __init__(self, script_file, data_dir = 'data'):
+        self.path = data_dir + '/' + script_file
+        self.names = {}
+        self.codes = {}
+        self.changed = False
+
+    def load(self):
+        self.names = {}
+        self.codes = {}
+        try:
+            with open(self.path, 'r') as f_handle:
+                for row in csv.DictReader(f_handle, REGISTRY_FIELDS):
+                    self.names[row['code']] = row['name']
+                    self.codes[row['name'].strip()] = row['code']
+        except Exception as e:
+            pass
+
+        self.changed = False
+        return self
+
+    def update(self, code, name):
+        previous_name = self.names.get(code)
+        if (previous_name == name):
+            return
+
+        if (previous_name is not None and self.codes.get(previous_name.strip()) == code):
+            del self.codes[previous_name.strip()]
+
+        self.names[code] = name
+        self.codes[name.strip()] = code
+        self.changed = True
+
+    def name(self, code):
+        return self.names.get(code)
+
+    def code(self, name):
+        return self.codes.get(name.strip())
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f_handle:
+            writer = csv.DictWriter(f_handle, REGISTRY_FIELDS)
+            for code in self.names:
+                writer.writerow({'code': code, 'name': self.names[code]})
+
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+
+def load_registry(script_file, data_dir = 'data'):
+    return ScripRegistry(script_file, data_dir).load()
@@ -0,0 +1,129 @@
+import csv
+import collections
+import os
+import ohlcv_store
+
+MAX_OPEN_FILES = 256
+MAX_BUFFERED_ROWS = 500000
+
+
+def last_csv_date(csv_file):
+    # Date of the last row of a scrip file, read from its tail.
+    try:
+        with open(csv_file, 'rb') as f_handle:
+            size = f_handle.seek(0, os.SEEK_END)
+            f_handle.seek(max(0, size - 512))
+            lines = [line for line in f_handle.read().splitlines() if line.strip()]
+    except FileNotFoundError as e:
+        return ''
+    if (len(lines) == 0):
+        return ''
+    return lines[-1].split(b',')[0].decode()
+
+
+class ScripDataWriter(object):
+    # Buffers OHLCV rows per scrip across any number of bhavcopy days and
+    # appends them to data/<exchange>/<code>.csv in one write per flush.
+    # Open handles are kept in an LRU pool so repeated flushes reuse them
+    # without going over the file descriptor limit. With a store_dir the same
+    # rows are also appended to the binary OHLCV store used by the TA stage.
+    # Rows are only flushed at the end of a day (end_day) or on a clean exit,
+    # and on_flush gets the days each flush wrote, so the caller can record
+    # them as ingested in the same step. Leaving the with block with an
+    # exception drops the buffered rows. Rows not newer than the last row of
+    # a scrip file are skipped, they were written by a flush that was cut
+    # off before its days were recorded.
+
+    def __init__(self, target_dir, store_dir = None, max_open_files = MAX_OPEN_FILES, max_buffered_rows = MAX_BUFFERED_ROWS, on_flush = None):
+        self.target_dir = target_dir
+        self.store_dir = store_dir
+        if (store_dir is not None):
+            os.makedirs(store_dir, exist_ok=True)
+        self.max_open_files = max_open_files
+        self.max_buffered_rows = max_buffered_rows
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.days = []
+        self.on_flush = on_flush
+        self.last_dates = {}
+        self.handles = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is None):
+            self.close()
+        else:
+            self.discard()
+
+    def append(self, code, row):
+        if (code not in self.buffers):
+            self.buffers[code] = []
+        self.buffers[code].append(row)
+        self.buffered_rows += 1
+
+    def end_day(self, day):
+        self.days.append(day)
+        if (self.buffered_rows >= self.max_buffered_rows):
+            self.flush()
+
+    def handle(self, code):
+        if (code in self.handles):
+            self.handles.move_to_end(code)
+            return self.handles[code]
+
+        if (len(self.handles) >= self.max_open_files):
+            _, least_recent = self.handles.popitem(last=False)
+            least_recent.close()
+
+        f_handle = open(self.target_dir + '/' + code + '.csv', 'a')
+        self.handles[code] = f_handle
+        return f_handle
+
+    def new_rows(self, code):
+        if (code not in self.last_dates):
+            self.last_dates[code] = last_csv_date(self.target_dir + '/' + code + '.csv')
+        rows = [row for row in self.buffers[code] if row[0] > self.last_dates[code]]
+        if (len(rows) > 0):
+            self.last_dates[code] = rows[-1][0]
+        return rows
+
+    def flush(self):
+        for code in self.buffers:
+            if (self.store_dir is not None):
+                self.store(code)
+            rows = self.new_rows(code)
+            if (len(rows) > 0):
+                csv.writer(self.handle(code)).writerows(rows)
+
+        for f_handle in self.handles.values():
+            f_handle.flush()
+
+        days = self.days
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.days = []
+        if (self.on_flush is not None and len(days) > 0):
+            self.on_flush(days)
+
+    def store(self, code):
+        # A scrip whose CSV predates the store gets its history imported
+        # first, so the binary file never holds only part of it.
+        path = ohlcv_store.store_path(self.store_dir, code)
+        csv_file = self.target_dir + '/' + code + '.csv'
+        if (not os.path.exists(path) and os.path.exists(csv_file)):
+            ohlcv_store.import_csv(path, csv_file)
+        ohlcv_store.append_rows(path, self.buffers[code])
+
+    def close(self):
+        self.flush()
+        self.discard()
+
+    def discard(self):
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.days = []
+        for f_handle in self.handles.values():
+            f_handle.close()
+        self.handles.clear()
@@ -0,0 +1,47 @@
+from itertools import compress
+
+# NaN marks the 'NA' warm-up rows of an indicator column.
+NA = float('nan')
+NA_FIELDS = {'nan': 'NA'}
+
+
+class Series(object):
+    # Columnar time series: one typed array per column (array.array, or a numpy
+    # array when the numpy kernels produced it) sharing a single list of dates.
+    # Some indicators emit int values (UP/DOWN of 0, RSI of 100) that have to be
+    # written as ints, those rows are flagged in the column's integral mask.
+    __slots__ = ('dates', 'columns', 'integral')
+
+    def __init__(self, dates):
+        self.dates = dates
+        self.columns = {}
+        self.integral = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def add_column(self, name, values, integral = None):
+        self.columns[name] = values
+        if (integral is not None):
+            self.integral[name] = integral
+
+    def add_column_from(self, source, name, target_name = None):
+        if (target_name is None):
+            target_name = name
+        self.add_column(target_name, source.columns[name], source.integral.get(name))
+
+    def formatted(self, name):
+        # The column as CSV fields, a whole column at a time: repr() like the
+        # csv module, 'NA' for NaN and ints where the integral mask is set.
+        values = self.columns[name].tolist()
+        text = list(map(repr, values))
+        fields = list(map(NA_FIELDS.get, text, text))
+        integral = self.integral.get(name)
+        if (integral is not None):
+            for i in compress(range(len(values)), integral.tolist()):
+                if (values[i] == values[i]):
+                    fields[i] = str(int(values[i]))
+        return fields
+
+    def csv_lines(self, fields):
+        return map(','.join, zip(*[self.dates if field == 'date' else self.formatted(field) for field in fields]))
@@ -1,208 +1,377 @@
 import csv
+import io
 import os
+import time
+from array import array
+from series import Series, NA
+import ohlcv_store
+import ohlcv_panel
+import fast_csv
+import ta_spec
+import log_queue
+import profiling
+from metrics import METRICS, batch_result
+
+try:
+    import ta_numpy
+except ImportError:
+    ta_numpy = None
 
 CSV_FIELDS = ['date', 'open', 'high', 'low', 'close', 'volume']
-TA_CSV_FIELDS = ['date', 'UP', 'DOWN', 'RSI', 'EMA_50', 'EMA_21', 'EMA_9', 'MACD', 'MACD_SIG', 'VOL_EMA', 'P_CHANGE']
+TA_CSV_FIELDS = ['date'] + [entry['column'] for entry in ta_spec.DEFAULT_SPEC]
+
+TA_BACKEND = os.getenv('TA_BACKEND', 'numpy')
+TA_SPEC = os.getenv('TA_SPEC')
+TA_WRITE_BUFFER = 1024 * 1024
+
+TA_PLAN = ta_spec.compile_spec(ta_spec.load_spec(TA_SPEC))
+DEFAULT_PLAN = ta_spec.compile_spec(ta_spec.DEFAULT_SPEC)
+
+def log(message, *args, error = False):
+    if (error == True):
+        log_queue.error(message, *args)
+    else:
+        log_queue.debug(message, *args)
+
+def numpy_enabled():
+    return TA_BACKEND == 'numpy' and ta_numpy is not None
 
-LOG_ENABLED = os.getenv('LOG_DEV', False)
+def plan_signature():
+    return str(TA_PLAN.outputs)
 
-def log(message, error = False):
-    if (error == True or LOG_ENABLED != False):
-        print(message)
+def custom_spec():
+    # The incremental and market-wide paths only produce the default columns.
+    return TA_PLAN.outputs != DEFAULT_PLAN.outputs
+
+def read_ohlcv_data(datafile, fields = CSV_FIELDS[1:]):
+    # Only the given fields are parsed from a CSV scrip file.
+    log('Reading OHLCV data from %s', datafile)
+    if (datafile.endswith(ohlcv_store.EXTENSION)):
+        return read_ohlcv_store(datafile)
 
-def rsi(datafile, n):
-    log('Calculating RSI for ' + datafile)
-    data = {}
-    
     with open(datafile, 'r') as f_handle:
-        reader = csv.DictReader(f_handle, CSV_FIELDS)
-        sum_up = 0
-        sum_down = 0
-        
-        for i, row in enumerate(reader):
-            convert_values_to_float(row)
-            index = str(i)
-            data[index] = {}
-            data[index]['date'] = row['date']
-            
-            if (row['open'] >= row['close']):
-                data[index]['UP'] = 0
-                data[index]['DOWN'] = round(row['open'] - row['close'], 4)
-            else:
-                data[index]['UP'] = round(row['close'] - row['open'], 4)
-                data[index]['DOWN'] = 0
-            
-            sum_up += data[index]['UP']
-            sum_down += data[index]['DOWN']
-            data[index]['RSI'] = 'NA'
-            
-            if (i == (n-1)):
-                if (sum_down <= 0.001):
-                    data[index]['RSI'] = 100
-                else:
-                    data[index]['RSI'] = round(100 - (100/(1+(sum_up/sum_down))), 4)
-            elif (i >= n):
-                sum_up -= data[str(i-n)]['UP']
-                sum_down -= data[str(i-n)]['DOWN']
-                if (sum_down <= 0.001):
-                    data[index]['RSI'] = 100
-                else:
-                    data[index]['RSI'] = round(100 - (100/(1+(sum_up/sum_down))), 4)
-    
-    log('RSI calculation completed for ' + datafile)
+        dates, columns = fast_csv.read_ohlcv_columns(f_handle.read(), fields, numpy_enabled())
+
+    ohlcv_data = Series(dates)
+    for field in fields:
+        ohlcv_data.add_column(field, columns[field])
+    return ohlcv_data
+
+
+def read_ohlcv_store(datafile):
+    # The numpy kernels work directly on the memory-mapped columns.
+    return series_from_columns(ohlcv_store.read_columns(datafile, numpy_enabled()))
+
+
+def series_from_columns(columns):
+    ohlcv_data = Series(ohlcv_store.dates(columns['date']))
+    for field in CSV_FIELDS[1:]:
+        ohlcv_data.add_column(field, columns[field])
+    return ohlcv_data
+
+
+def rsi(ohlcv_data, n):
+    data = price_changes(ohlcv_data)
+    data.add_column_from(rsi_from_changes(data, n), 'RSI')
     return data
 
 
-def moving_average(datafile, field, n):
-    log('Calculating ' + str(n) + ' days Exponential Moving Average for ' + field + ' field')
-    data = {}
-    
-    with open(datafile, 'r') as f_handle:
-        reader = csv.DictReader(f_handle, CSV_FIELDS)
-        sum_field = 0
-
-        for i, row in enumerate(reader):
-            convert_values_to_float(row)
-            index = str(i)
-            data[index] = {}
-            sum_field += row[field]
-            data[index]['date'] = row['date']
-            
-            if (i == (n-1)):
-                data[index]['EMA'] = round(sum_field/n, 4)
-            elif (i >= n):
-                data[index]['EMA'] = round((row[field]*(2/(1+n)))+(data[str(i-1)]['EMA']*(1 - (2/(n+1)))), 4)
+def price_changes(ohlcv_data):
+    data = Series(ohlcv_data.dates)
+    open_values = ohlcv_data.columns['open']
+    close_values = ohlcv_data.columns['close']
+
+    if (numpy_enabled()):
+        up, down, falling = ta_numpy.price_changes(ta_numpy.view(open_values), ta_numpy.view(close_values))
+        data.add_column('UP', up, falling)
+        data.add_column('DOWN', down, ~falling)
+        return data
+
+    up = array('d')
+    down = array('d')
+    falling = array('b')
+    rising = array('b')
+
+    for i in range(len(ohlcv_data)):
+        if (open_values[i] >= close_values[i]):
+            up.append(0)
+            down.append(round(open_values[i] - close_values[i], 4))
+            falling.append(1)
+            rising.append(0)
+        else:
+            up.append(round(close_values[i] - open_values[i], 4))
+            down.append(0)
+            falling.append(0)
+            rising.append(1)
+
+    data.add_column('UP', up, falling)
+    data.add_column('DOWN', down, rising)
+    return data
+
+
+def rsi_from_changes(changes, n):
+    log('Calculating RSI(%d)', n)
+    data = Series(changes.dates)
+    up = changes.columns['UP']
+    down = changes.columns['DOWN']
+
+    if (numpy_enabled()):
+        values, saturated = ta_numpy.rsi_values(ta_numpy.view(up), ta_numpy.view(down), n)
+        data.add_column('RSI', values, saturated)
+        log('RSI(%d) calculation completed', n)
+        return data
+
+    values = array('d')
+    saturated = array('b')
+    sum_up = 0
+    sum_down = 0
+
+    for i in range(len(changes)):
+        sum_up += up[i]
+        sum_down += down[i]
+        values.append(NA)
+        saturated.append(0)
+
+        if (i >= n):
+            sum_up -= up[i-n]
+            sum_down -= down[i-n]
+
+        if (i >= (n-1)):
+            if (sum_down <= 0.001):
+                values[i] = 100
+                saturated[i] = 1
             else:
-                data[index]['EMA'] = 'NA'
-                
-    log('Calculation of ' + str(n) + ' days Exponential Moving Average for ' + field + ' field: Completed')
+                values[i] = round(100 - (100/(1+(sum_up/sum_down))), 4)
+
+    data.add_column('RSI', values, saturated)
+    log('RSI(%d) calculation completed', n)
     return data
 
 
-def convert_values_to_float(csv_row):
-    csv_row['open'] = i2f(csv_row['open'])
-    csv_row['close'] = i2f(csv_row['close'])
-    csv_row['high'] = i2f(csv_row['high'])
-    csv_row['low'] = i2f(csv_row['low'])
-    csv_row['volume'] = int(csv_row['volume'])
+def moving_average(ohlcv_data, field, n):
+    log('Calculating %d days Exponential Moving Average for %s field', n, field)
+    data = Series(ohlcv_data.dates)
+    data.add_column('EMA', exponential_moving_average(ohlcv_data.columns[field], n))
+    log('Calculation of %d days Exponential Moving Average for %s field: Completed', n, field)
+    return data
+
+
+def exponential_moving_average(field_values, n):
+    if (numpy_enabled()):
+        return ta_numpy.moving_average(ta_numpy.view(field_values), n)
+
+    values = array('d')
+    sum_field = 0
+
+    for i in range(len(field_values)):
+        sum_field += field_values[i]
+
+        if (i == (n-1)):
+            values.append(round(sum_field/n, 4))
+        elif (i >= n):
+            values.append(round((field_values[i]*(2/(1+n)))+(values[i-1]*(1 - (2/(n+1)))), 4))
+        else:
+            values.append(NA)
+
+    return values
 
 
-def macd(datafile, low_n, high_n, signal):
-    log('Calculating MACD('+str(high_n)+', '+str(low_n)+', '+str(signal)+') for ' + datafile)
+def macd(ohlcv_data, low_n, high_n, signal):
     if (low_n > high_n):
         high_n += low_n
         low_n = high_n - low_n
         high_n -= low_n
 
-    ma_low = moving_average(datafile, 'close', low_n)
-    ma_high = moving_average(datafile, 'close', high_n)
-    i = 0;
-    data = {}
-
-    while(i < len(ma_high)):
-        index = str(i)
-        data[index] = {}
-        
-        data[index]['date'] = ma_low[index]['date']
-        
-        if (i < (high_n - 1)):
-            data[index]['MACD'] = 'NA'
-        else:
-            data[index]['MACD'] = round(ma_low[index]['EMA'] - ma_high[index]['EMA'], 4)
-
-        i += 1
-    
-    log('Calculation of MACD('+str(high_n)+', '+str(low_n)+', '+str(signal)+') for ' + datafile + ' Completed')
+    ma_low = moving_average(ohlcv_data, 'close', low_n).columns['EMA']
+    ma_high = moving_average(ohlcv_data, 'close', high_n).columns['EMA']
+    data = macd_line(ohlcv_data, ma_low, ma_high, low_n, high_n)
     return calculate_macd_signal(data, high_n, signal)
-    
+
+
+def macd_line(ohlcv_data, ma_low, ma_high, low_n, high_n):
+    log('Calculating MACD(%d, %d)', high_n, low_n)
+    data = Series(ohlcv_data.dates)
+
+    if (numpy_enabled()):
+        data.add_column('MACD', ta_numpy.macd_values(ta_numpy.view(ma_low), ta_numpy.view(ma_high), high_n))
+    else:
+        values = array('d')
+
+        for i in range(len(ohlcv_data)):
+            if (i < (high_n - 1)):
+                values.append(NA)
+            else:
+                values.append(round(ma_low[i] - ma_high[i], 4))
+
+        data.add_column('MACD', values)
+
+    log('Calculation of MACD(%d, %d) Completed', high_n, low_n)
+    return data
+
 
 def calculate_macd_signal(data, high_n, signal):
+    data.add_column_from(macd_signal(data, high_n, signal), 'MACD_SIG')
+    return data
+
+
+def macd_signal(macd_data, high_n, signal):
     log('Generating signal data for previously computed MACD data')
-    i = 0
+    data = Series(macd_data.dates)
+    macd_values = macd_data.columns['MACD']
+
+    if (numpy_enabled()):
+        data.add_column('MACD_SIG', ta_numpy.macd_signal(ta_numpy.view(macd_values), high_n, signal))
+        log('Signal data for previously computed MACD data generated')
+        return data
+
+    values = array('d')
     sum_macd = 0
-    
-    while i < len(data):
-        index = str(i)
-        
+
+    for i in range(len(macd_data)):
         if (i < (high_n - 1)):
-            data[index]['MACD_SIG'] = 'NA'
+            values.append(NA)
         elif (i < (high_n + signal - 2)):
-            data[index]['MACD_SIG'] = 'NA'
-            sum_macd += data[index]['MACD']
+            values.append(NA)
+            sum_macd += macd_values[i]
         elif (i == (high_n + signal - 2)):
-            sum_macd += data[index]['MACD']
-            data[index]['MACD_SIG'] = round(sum_macd/signal, 4)
+            sum_macd += macd_values[i]
+            values.append(round(sum_macd/signal, 4))
         else:
-            sum_macd += data[index]['MACD'] - data[str(i - signal)]['MACD']
-            data[index]['MACD_SIG'] = round(sum_macd/signal, 4)
-
-        i += 1
+            sum_macd += macd_values[i] - macd_values[i - signal]
+            values.append(round(sum_macd/signal, 4))
 
+    data.add_column('MACD_SIG', values)
     log('Signal data for previously computed MACD data generated')
     return data
 
 
-def percent_change(datafile):
-    log('Calculating %change for ' + datafile)
-    with open(datafile, 'r') as f_handle:
-        reader = csv.DictReader(f_handle, CSV_FIELDS)
-        prev_close = -1
-        data = {}
-
-        for i, row in enumerate(reader):
-            convert_values_to_float(row)
-            index = str(i)
-            data[index] = {}
-            data[index]['date'] = row['date']
-            
-            if (i == 0):
-                prev_close = row['open']
-            
-            data[index]['PCHANGE'] = round(100*(row['close'] - prev_close)/prev_close, 4)
-            prev_close = row['close']
-
-        log('Calculation completed for %change for ' + datafile)
+def percent_change(ohlcv_data):
+    log('Calculating %change')
+    data = Series(ohlcv_data.dates)
+    open_values = ohlcv_data.columns['open']
+    close_values = ohlcv_data.columns['close']
+
+    if (numpy_enabled()):
+        data.add_column('PCHANGE', ta_numpy.percent_change(ta_numpy.view(open_values), ta_numpy.view(close_values)))
+        log('Calculation completed for %change')
         return data
 
+    values = array('d')
+    prev_close = -1
+
+    for i in range(len(ohlcv_data)):
+        if (i == 0):
+            prev_close = open_values[i]
+
+        values.append(round(100*(close_values[i] - prev_close)/prev_close, 4))
+        prev_close = close_values[i]
+
+    data.add_column('PCHANGE', values)
+    log('Calculation completed for %change')
+    return data
+
 
 def calculate_ta(datafile):
-    log('Starting calculation of Technical Analysis data for ' + datafile)
-    rsi_14 = rsi(datafile, 14)
-    ma_50 = moving_average(datafile, 'close', 50)
-    ma_21 = moving_average(datafile, 'close', 21)
-    ma_9 = moving_average(datafile, 'close', 9)
-    mcd = macd(datafile, 12, 26, 9)
-    vma_10 = moving_average(datafile, 'volume', 10)
-    pchange = percent_change(datafile)
-
-    data = {}
-    for index in pchange:
-        data[index] = rsi_14[index]
-        data[index]['EMA_50'] = ma_50[index]['EMA']
-        data[index]['EMA_21'] = ma_21[index]['EMA']
-        data[index]['EMA_9'] = ma_9[index]['EMA']
-        data[index]['MACD'] = mcd[index]['MACD']
-        data[index]['MACD_SIG'] = mcd[index]['MACD_SIG']
-        data[index]['VOL_EMA'] = vma_10[index]['EMA']
-        data[index]['P_CHANGE'] = pchange[index]['PCHANGE']
-
-    log('Calculation of Technical Analysis data completed for ' + datafile)
+    log('Starting calculation of Technical Analysis data for %s', datafile)
+    with METRICS.timer('ta.read'):
+        ohlcv_data = read_ohlcv_data(datafile, TA_PLAN.fields)
+    data = calculate_ta_data(ohlcv_data)
+    log('Calculation of Technical Analysis data completed for %s', datafile)
     return data
 
 
+def calculate_ta_data(ohlcv_data):
+    return TA_PLAN.run(ohlcv_data, compute_node)
+
+
+def compute_node(ohlcv_data, key, inputs):
+    # Timed per node, e.g. ta.ema_close_50, so the metrics show the time
+    # spent in every indicator.
+    with METRICS.timer('ta.' + '_'.join(str(part) for part in key)):
+        return node_series(ohlcv_data, key, inputs)
+
+
+def node_series(ohlcv_data, key, inputs):
+    if (key[0] == 'changes'):
+        return price_changes(ohlcv_data)
+    elif (key[0] == 'rsi'):
+        return rsi_from_changes(inputs[0], key[1])
+    elif (key[0] == 'ema'):
+        return moving_average(ohlcv_data, key[1], key[2])
+    elif (key[0] == 'macd'):
+        return macd_line(ohlcv_data, inputs[0].columns['EMA'], inputs[1].columns['EMA'], key[1], key[2])
+    elif (key[0] == 'macd_signal'):
+        return macd_signal(inputs[0], key[2], key[3])
+    return percent_change(ohlcv_data)
+
+
 def write_ta_data_to_file(data, destination_file):
-    log('Writing Technical Analysis data to ' + destination_file)
-    with open(destination_file, 'w') as f_handle:
-        writer = csv.DictWriter(f_handle, TA_CSV_FIELDS)
-        writer.writeheader()
-        for index in data:
-            writer.writerow(data[index])
+    # Rows are formatted from the columns in bulk and written in one go to a
+    # temporary file that replaces the TA file, so readers never see a half
+    # written file. The bytes are the same csv.writer would write.
+    log('Writing Technical Analysis data to %s', destination_file)
+    fields = ['date'] + list(data.columns)
+    with METRICS.timer('ta.write'):
+        header = io.StringIO()
+        csv.writer(header).writerow(fields)
+        body = '\r\n'.join(data.csv_lines(fields))
+        try:
+            with open(destination_file + '.tmp', 'w', buffering=TA_WRITE_BUFFER) as f_handle:
+                f_handle.write(header.getvalue())
+                if (body != ''):
+                    f_handle.write(body + '\r\n')
+        except Exception as e:
+            if (os.path.exists(destination_file + '.tmp')):
+                os.remove(destination_file + '.tmp')
+            raise
+        os.replace(destination_file + '.tmp', destination_file)
+
+
+def record_scrip(name, start):
+    seconds = time.perf_counter() - start
+    METRICS.add_time('ta.scrip', seconds)
+    METRICS.set_value('ta_scrip_seconds', name, round(seconds, 6))
 
 
 def initialize_ta_data(datafile, destination_file):
+    start = time.perf_counter()
     data = calculate_ta(datafile)
     write_ta_data_to_file(data, destination_file)
+    record_scrip(datafile, start)
+
+
+def initialize_ta_batch(jobs):
+    processed = 0
+    for datafile, destination_file in jobs:
+        try:
+            with profiling.scrip(datafile):
+                initialize_ta_data(datafile, destination_file)
+            processed += 1
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            log('Failed to generate Technical Analysis data for %s: %s', datafile, e, error=True)
+    return batch_result(processed)
+
+
+def initialize_ta_panel_batch(jobs):
+    # jobs are (panel, code, destination_file) for one panel, its scrips are
+    # read together in a single pass over the panel.
+    panel = jobs[0][0]
+    destination_files = {code: destination_file for _, code, destination_file in jobs}
+    processed = 0
+    for code, columns in ohlcv_panel.read_scrips(panel, list(destination_files), numpy_enabled()):
+        try:
+            log('Starting calculation of Technical Analysis data for %s in %s', code, panel)
+            start = time.perf_counter()
+            with profiling.scrip(code):
+                write_ta_data_to_file(calculate_ta_data(series_from_columns(columns)), destination_files[code])
+            record_scrip(code + ' in ' + panel, start)
+            processed += 1
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            log('Failed to generate Technical Analysis data for %s in %s: %s', code, panel, e, error=True)
+    return batch_result(processed)
 
 
 def i2f(value):
-    return round(float(value), 4)
\ No newline at end of file
+    return round(float(value), 4)
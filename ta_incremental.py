@@ -0,0 +1,207 @@
+import csv
+import json
+import os
+import time
+import ta
+import ta_spec
+import fast_csv
+import profiling
+from metrics import METRICS, batch_result
+
+# Incremental TA: each scrip keeps the running state of every indicator in a
+# small JSON file, so a daily update only parses and appends the new bars
+# instead of recomputing the full history. The per-bar arithmetic below is
+# the same as the loops in ta.py, so appended rows match a full rebuild.
+# Columns and periods are those of ta_spec.DEFAULT_SPEC.
+
+RSI_N = int(ta_spec.default_entry('rsi')['period'])
+MACD_LOW_N, MACD_HIGH_N, MACD_SIGNAL = ta_spec.default_macd()
+EMA_COLUMNS = ta_spec.default_emas()
+EMA_FIELDS = list(dict.fromkeys([(field, n) for _, field, n in EMA_COLUMNS] + [('close', MACD_LOW_N), ('close', MACD_HIGH_N)]))
+COLUMNS = {indicator: ta_spec.default_entry(indicator)['column'] for indicator in ('up', 'down', 'rsi', 'macd', 'macd_signal', 'pchange')}
+
+
+def ema_key(field, n):
+    return field + '_' + str(n)
+
+
+def new_state():
+    return {
+        'plan': ta.plan_signature(),
+        'count': 0,
+        'offset': 0,
+        'ta_size': 0,
+        'date': None,
+        'prev_close': None,
+        'rsi': {'up': [], 'down': [], 'sum_up': 0, 'sum_down': 0},
+        'ema': {ema_key(field, n): {'sum': 0, 'ema': None} for field, n in EMA_FIELDS},
+        'macd': {'values': [], 'sum': 0}
+    }
+
+
+def step_rsi(state, row, i, n):
+    rsi_state = state['rsi']
+    if (row['open'] >= row['close']):
+        up = 0
+        down = round(row['open'] - row['close'], 4)
+    else:
+        up = round(row['close'] - row['open'], 4)
+        down = 0
+
+    rsi_state['sum_up'] += up
+    rsi_state['sum_down'] += down
+    rsi_state['up'].append(up)
+    rsi_state['down'].append(down)
+
+    if (i >= n):
+        rsi_state['sum_up'] -= rsi_state['up'].pop(0)
+        rsi_state['sum_down'] -= rsi_state['down'].pop(0)
+
+    value = 'NA'
+    if (i >= (n-1)):
+        if (rsi_state['sum_down'] <= 0.001):
+            value = 100
+        else:
+            value = round(100 - (100/(1+(rsi_state['sum_up']/rsi_state['sum_down']))), 4)
+
+    return up, down, value
+
+
+def step_ema(state, row, i, field, n):
+    ema_state = state['ema'][ema_key(field, n)]
+    if (i < n):
+        ema_state['sum'] += row[field]
+
+    if (i == (n-1)):
+        ema_state['ema'] = round(ema_state['sum']/n, 4)
+    elif (i >= n):
+        ema_state['ema'] = round((row[field]*(2/(1+n)))+(ema_state['ema']*(1 - (2/(n+1)))), 4)
+    else:
+        return 'NA'
+
+    return ema_state['ema']
+
+
+def step_macd(state, i, ma_low, ma_high, high_n, signal):
+    if (i < (high_n - 1)):
+        return 'NA', 'NA'
+
+    macd_state = state['macd']
+    value = round(ma_low - ma_high, 4)
+
+    if (i < (high_n + signal - 2)):
+        macd_state['sum'] += value
+        macd_state['values'].append(value)
+        return value, 'NA'
+    elif (i == (high_n + signal - 2)):
+        macd_state['sum'] += value
+        macd_state['values'].append(value)
+    else:
+        macd_state['sum'] += value - macd_state['values'].pop(0)
+        macd_state['values'].append(value)
+
+    return value, round(macd_state['sum']/signal, 4)
+
+
+def step_percent_change(state, row, i):
+    if (i == 0):
+        state['prev_close'] = row['open']
+
+    value = round(100*(row['close'] - state['prev_close'])/state['prev_close'], 4)
+    state['prev_close'] = row['close']
+    return value
+
+
+def step(state, row):
+    i = state['count']
+    up, down, rsi_value = step_rsi(state, row, i, RSI_N)
+    ema = {}
+    for field, n in EMA_FIELDS:
+        ema[ema_key(field, n)] = step_ema(state, row, i, field, n)
+    macd_value, macd_signal = step_macd(state, i, ema[ema_key('close', MACD_LOW_N)], ema[ema_key('close', MACD_HIGH_N)], MACD_HIGH_N, MACD_SIGNAL)
+    p_change = step_percent_change(state, row, i)
+
+    state['count'] = i + 1
+    state['date'] = row['date']
+    values = {COLUMNS['up']: up, COLUMNS['down']: down, COLUMNS['rsi']: rsi_value,
+              COLUMNS['macd']: macd_value, COLUMNS['macd_signal']: macd_signal, COLUMNS['pchange']: p_change}
+    for column, field, n in EMA_COLUMNS:
+        values[column] = ema[ema_key(field, n)]
+    return [row['date']] + [values[column] for column in ta.TA_CSV_FIELDS[1:]]
+
+
+def load_state(state_file):
+    try:
+        with open(state_file, 'r') as f_handle:
+            return json.load(f_handle)
+    except Exception as e:
+        return None
+
+
+def save_state(state, state_file):
+    with open(state_file + '.tmp', 'w') as f_handle:
+        json.dump(state, f_handle)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def read_new_rows(datafile, offset):
+    with open(datafile, 'rb') as f_handle:
+        f_handle.seek(offset)
+        content = f_handle.read()
+
+    return fast_csv.read_ohlcv_rows(content.decode()), offset + len(content)
+
+
+def state_is_valid(state, datafile, destination_file):
+    # A state from another indicator plan would append other columns.
+    if (state is None or state.get('plan') != ta.plan_signature() or not os.path.exists(destination_file)):
+        return False
+    return os.path.getsize(datafile) >= state['offset'] and os.path.getsize(destination_file) == state['ta_size']
+
+
+def update_ta_data(datafile, destination_file, state_file):
+    state = load_state(state_file)
+    if (state_is_valid(state, datafile, destination_file)):
+        mode = 'a'
+    else:
+        ta.log('No usable TA state for %s, rebuilding %s', datafile, destination_file)
+        state = new_state()
+        mode = 'w'
+
+    rows, state['offset'] = read_new_rows(datafile, state['offset'])
+    ta.log('Appending %d Technical Analysis rows to %s', len(rows), destination_file)
+
+    # A rebuild goes through a temporary file like a full TA run, the old TA
+    # file stays in place until the new one is complete.
+    filename = destination_file if (mode == 'a') else destination_file + '.tmp'
+    try:
+        with open(filename, mode) as f_handle:
+            writer = csv.writer(f_handle)
+            if (mode == 'w'):
+                writer.writerow(ta.TA_CSV_FIELDS)
+            for row in rows:
+                writer.writerow(step(state, row))
+    except Exception as e:
+        if (mode == 'w' and os.path.exists(filename)):
+            os.remove(filename)
+        raise
+    if (mode == 'w'):
+        os.replace(filename, destination_file)
+
+    state['ta_size'] = os.path.getsize(destination_file)
+    save_state(state, state_file)
+
+
+def update_ta_batch(jobs):
+    processed = 0
+    for datafile, destination_file, state_file in jobs:
+        try:
+            start = time.perf_counter()
+            with profiling.scrip(datafile):
+                update_ta_data(datafile, destination_file, state_file)
+            ta.record_scrip(datafile, start)
+            processed += 1
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            ta.log('Failed to update Technical Analysis data for %s: %s', datafile, e, error=True)
+    return batch_result(processed)
@@ -0,0 +1,70 @@
+import json
+import os
+
+
+def file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError as e:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TaManifest(object):
+    # Signatures (size, mtime) of the source and the output of every TA file
+    # in a directory, plus the indicator plan it was computed with. A job is
+    # skipped while all three still match, so scrips that did not trade are
+    # not recomputed. An entry is only recorded once the output was really
+    # rewritten, a failed job is retried on the next run.
+
+    def __init__(self, path, spec):
+        self.path = path
+        self.spec = spec
+        self.entries = {}
+        self.pending = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f_handle:
+                self.entries = json.load(f_handle)
+        except Exception as e:
+            self.entries = {}
+        return self
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f_handle:
+            json.dump(self.entries, f_handle)
+        os.replace(self.path + '.tmp', self.path)
+
+    def is_current(self, datafile, destination_file):
+        entry = self.entries.get(destination_file)
+        if (entry is None or entry['spec'] != self.spec or entry['source'] != datafile):
+            return False
+        return entry['source_signature'] == file_signature(datafile) and entry['output_signature'] == file_signature(destination_file)
+
+    def changed(self, jobs, force = False):
+        changed_jobs = []
+        for job in jobs:
+            datafile, destination_file = job[0], job[1]
+            if (not force and self.is_current(datafile, destination_file)):
+                continue
+            self.pending[destination_file] = (datafile, file_signature(datafile), file_signature(destination_file))
+            changed_jobs.append(job)
+        return changed_jobs
+
+    def record(self):
+        for destination_file, (datafile, source_signature, previous_output) in self.pending.items():
+            output_signature = file_signature(destination_file)
+            if (output_signature is None or output_signature == previous_output):
+                continue
+            self.entries[destination_file] = {
+                'source': datafile,
+                'source_signature': source_signature,
+                'output_signature': output_signature,
+                'spec': self.spec
+            }
+        self.pending = {}
+
+
+def load_ta_manifest(destination_dir, spec):
+    return TaManifest(destination_dir + '_manifest.json', spec).load()
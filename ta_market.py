@@ -0,0 +1,131 @@
+import numpy as np
+import ta
+import ta_numpy
+import ta_spec
+import ohlcv_panel
+import profiling
+from series import Series
+from metrics import METRICS, batch_result
+
+# Market-wide TA: the scrips of a batch are laid out side by side in bar x
+# scrip matrices and each indicator runs once over the whole matrix, so the
+# EMA recurrence takes one vector step per bar instead of one Python loop
+# per scrip. Row i of a column is that scrip's i-th bar, not a calendar
+# date, so later listing dates and missing days only make a column shorter
+# (it is padded at the end) and every value matches the per-scrip output.
+# Columns and periods are those of ta_spec.DEFAULT_SPEC.
+
+RSI_N = int(ta_spec.default_entry('rsi')['period'])
+MACD_LOW_N, MACD_HIGH_N, MACD_SIGNAL = ta_spec.default_macd()
+EMA_COLUMNS = ta_spec.default_emas()
+COLUMNS = {indicator: ta_spec.default_entry(indicator)['column'] for indicator in ('up', 'down', 'rsi', 'macd', 'macd_signal', 'pchange')}
+MARKET_FIELDS = list(dict.fromkeys(['open', 'close'] + [field for _, field, _ in EMA_COLUMNS]))
+
+
+def bar_matrix(series_list, field, dtype, fill):
+    matrix = np.full((max(len(ohlcv_data) for ohlcv_data in series_list), len(series_list)), fill, dtype=dtype)
+    for j, ohlcv_data in enumerate(series_list):
+        matrix[:len(ohlcv_data), j] = ta_numpy.view(ohlcv_data.columns[field])
+    return matrix
+
+
+def zero_previous_close(open_values, close_values, lengths):
+    # Per scrip, ta.percent_change raises on a zero previous close, those
+    # scrips fail here as well.
+    zero = ta_numpy.previous_close(open_values, close_values) == 0
+    rows = np.arange(len(open_values))[:, None]
+    return (zero & (rows < lengths)).any(axis=0)
+
+
+def calculate_ta_market(series_list):
+    ta.log('Calculating Technical Analysis data for %d scrips', len(series_list))
+    lengths = np.array([len(ohlcv_data) for ohlcv_data in series_list])
+    matrices = {}
+    for field in MARKET_FIELDS:
+        matrices[field] = bar_matrix(series_list, field, np.int64, 0) if field == 'volume' else bar_matrix(series_list, field, np.float64, np.nan)
+    open_values = matrices['open']
+    close_values = matrices['close']
+
+    up, down, rsi_values, falling, saturated = ta_numpy.rsi(open_values, close_values, RSI_N)
+    columns = {
+        COLUMNS['up']: (up, falling),
+        COLUMNS['down']: (down, ~falling),
+        COLUMNS['rsi']: (rsi_values, saturated),
+        COLUMNS['pchange']: (ta_numpy.percent_change(open_values, close_values), None)
+    }
+    for column, field, n in EMA_COLUMNS:
+        columns[column] = (ta_numpy.moving_average(matrices[field], n), None)
+    macd_values = ta_numpy.macd(close_values, MACD_LOW_N, MACD_HIGH_N)
+    columns[COLUMNS['macd']] = (macd_values, None)
+    columns[COLUMNS['macd_signal']] = (ta_numpy.macd_signal(macd_values, MACD_HIGH_N, MACD_SIGNAL), None)
+    failed = zero_previous_close(open_values, close_values, lengths)
+
+    results = []
+    for j, ohlcv_data in enumerate(series_list):
+        if (failed[j]):
+            results.append(None)
+            continue
+
+        data = Series(ohlcv_data.dates)
+        for name in ta.TA_CSV_FIELDS[1:]:
+            values, integral = columns[name]
+            data.add_column(name, values[:len(ohlcv_data), j], None if integral is None else integral[:len(ohlcv_data), j])
+        results.append(data)
+
+    ta.log('Calculation of Technical Analysis data completed for %d scrips', len(series_list))
+    return results
+
+
+def write_market_ta(names, series_list, destination_files):
+    processed = 0
+    # Indicators run once per batch here, ta.market times the whole batch.
+    with METRICS.timer('ta.market'):
+        results = calculate_ta_market(series_list)
+    for name, data, destination_file in zip(names, results, destination_files):
+        if (data is None):
+            METRICS.increment('ta.failures')
+            ta.log('Failed to generate Technical Analysis data for %s: float division by zero', name, error=True)
+            continue
+        try:
+            ta.write_ta_data_to_file(data, destination_file)
+            processed += 1
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            ta.log('Failed to generate Technical Analysis data for %s: %s', name, e, error=True)
+    return processed
+
+
+def initialize_ta_batch(jobs):
+    names = []
+    series_list = []
+    destination_files = []
+    for datafile, destination_file in jobs:
+        try:
+            with METRICS.timer('ta.read'):
+                series_list.append(ta.read_ohlcv_data(datafile, MARKET_FIELDS))
+            names.append(datafile)
+            destination_files.append(destination_file)
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            ta.log('Failed to generate Technical Analysis data for %s: %s', datafile, e, error=True)
+
+    if (len(series_list) == 0):
+        return batch_result(0)
+    # Sampled per batch, a batch is computed as a whole.
+    with profiling.scrip(names[0]):
+        processed = write_market_ta(names, series_list, destination_files)
+    return batch_result(processed)
+
+
+def initialize_ta_panel_batch(jobs):
+    panel = jobs[0][0]
+    destination_files = {code: destination_file for _, code, destination_file in jobs}
+    names = []
+    series_list = []
+    for code, columns in ohlcv_panel.read_scrips(panel, list(destination_files), True):
+        names.append(code)
+        series_list.append(ta.series_from_columns(columns))
+
+    with profiling.scrip(jobs[0][1]):
+        processed = write_market_ta([code + ' in ' + panel for code in names], series_list, [destination_files[code] for code in names])
+    return batch_result(processed)
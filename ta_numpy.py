@@ -0,0 +1,149 @@
+import numpy as np
+
+# Vectorized versions of the indicators in ta.py. Every kernel takes float64
+# (or int64 for volume) arrays and returns float64 arrays where NaN marks the
+# 'NA' warm-up rows, so results stay identical to the pure Python loops.
+# They also accept bar x scrip matrices and then run along the first axis,
+# one column per scrip.
+
+def view(values):
+    # array.array columns expose the buffer protocol, so this does not copy.
+    return np.asarray(values)
+
+
+def round_values(values):
+    # np.round scales by 10^4 before rounding while round() looks at the exact
+    # binary value, so the two only disagree next to a .5 boundary. Those few
+    # entries are rounded again with round() to keep the output identical.
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = values * 10000.0
+        rounded = np.rint(scaled) / 10000.0
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 4 * np.spacing(np.abs(scaled))
+
+    for i in np.flatnonzero(near_tie):
+        rounded.flat[i] = round(float(values.flat[i]), 4)
+
+    return rounded
+
+
+def rolling_sum(values, n):
+    # Replays the running "add newest, subtract oldest" sequence of ta.py with
+    # cumsum (which accumulates strictly left to right) so every window total
+    # carries exactly the same floating point error as the original loop.
+    count = len(values)
+    if (count < n):
+        return np.empty((0,) + values.shape[1:])
+
+    steps = np.empty((n + 2*(count - n),) + values.shape[1:])
+    steps[:n] = values[:n]
+    steps[n::2] = values[n:]
+    steps[n+1::2] = -values[:count - n]
+    return np.cumsum(steps, axis=0)[n-1::2]
+
+
+def rsi(open_values, close_values, n):
+    up, down, falling = price_changes(open_values, close_values)
+    values, saturated = rsi_values(up, down, n)
+    return up, down, values, falling, saturated
+
+
+def price_changes(open_values, close_values):
+    falling = open_values >= close_values
+    change = round_values(np.abs(close_values - open_values))
+    up = np.where(falling, 0.0, change)
+    down = np.where(falling, change, 0.0)
+    return up, down, falling
+
+
+def rsi_values(up, down, n):
+    values = np.full(up.shape, np.nan)
+    saturated = np.zeros(up.shape, dtype=bool)
+    sum_up = rolling_sum(up, n)
+    sum_down = rolling_sum(down, n)
+
+    if (len(sum_down) > 0):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = round_values(100 - (100/(1+(sum_up/sum_down))))
+        saturated[n-1:] = sum_down <= 0.001
+        values[n-1:] = np.where(saturated[n-1:], 100.0, ratio)
+
+    return values, saturated
+
+
+def moving_average(values, n):
+    # Each EMA step is rounded before it feeds the next one, so the recurrence
+    # cannot be expressed as a vector operation without changing the output.
+    # It runs over plain Python numbers, which is the fastest exact option
+    # for one scrip, a matrix steps through its rows instead.
+    result = np.full(values.shape, np.nan)
+    if (len(values) < n):
+        return result
+
+    if (values.ndim > 1):
+        return moving_average_rows(values, n, result)
+
+    sum_field = 0
+    for value in values[:n].tolist():
+        sum_field += value
+
+    alpha = 2/(1+n)
+    beta = 1 - (2/(n+1))
+    ema = round(sum_field/n, 4)
+    ema_values = [ema]
+    for value in values[n:].tolist():
+        ema = round((value*alpha)+(ema*beta), 4)
+        ema_values.append(ema)
+
+    result[n-1:] = ema_values
+    return result
+
+
+def moving_average_rows(values, n, result):
+    alpha = 2/(1+n)
+    beta = 1 - (2/(n+1))
+    ema = round_values(np.cumsum(values[:n], axis=0)[-1]/n)
+    result[n-1] = ema
+    for i in range(n, len(values)):
+        ema = round_values((values[i]*alpha)+(ema*beta))
+        result[i] = ema
+    return result
+
+
+def macd(close_values, low_n, high_n):
+    return macd_values(moving_average(close_values, low_n), moving_average(close_values, high_n), high_n)
+
+
+def macd_values(ma_low, ma_high, high_n):
+    values = np.full(ma_low.shape, np.nan)
+    values[high_n-1:] = round_values(ma_low[high_n-1:] - ma_high[high_n-1:])
+    return values
+
+
+def macd_signal(macd_values, high_n, signal):
+    count = len(macd_values)
+    values = np.full(macd_values.shape, np.nan)
+    start = high_n + signal - 2
+    if (count <= start):
+        return values
+
+    steps = np.concatenate((macd_values[high_n-1:start+1], macd_values[start+1:] - macd_values[start+1-signal:count-signal]))
+    values[start:] = round_values(np.cumsum(steps, axis=0)[signal-1:]/signal)
+    return values
+
+
+def percent_change(open_values, close_values):
+    if (len(close_values) == 0):
+        return np.empty(close_values.shape)
+
+    prev_close = previous_close(open_values, close_values)
+    if (close_values.ndim == 1 and (prev_close == 0).any()):
+        raise ZeroDivisionError('float division by zero')
+
+    # Matrix columns with a zero previous close get inf/NaN, callers check
+    # them with previous_close() and drop those scrips.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return round_values(100*(close_values - prev_close)/prev_close)
+
+
+def previous_close(open_values, close_values):
+    return np.concatenate((open_values[:1], close_values[:-1]))
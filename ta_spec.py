@@ -0,0 +1,145 @@
+import json
+from series import Series
+
+# Declarative indicator sets. A spec is a JSON list of output columns, e.g.
+#   [{"column": "RSI_7", "indicator": "rsi", "period": 7},
+#    {"column": "EMA_200", "indicator": "ema", "field": "close", "period": 200},
+#    {"column": "MACD", "indicator": "macd", "fast": 12, "slow": 26},
+#    {"column": "MACD_SIG", "indicator": "macd_signal", "fast": 12, "slow": 26, "signal": 9}]
+# It is compiled into a graph of nodes keyed by indicator and parameters, so
+# inputs shared by several columns (up/down moves, EMAs, the MACD line) are
+# computed once per scrip, in dependency order, and only the listed columns
+# are written.
+
+DEFAULT_SPEC = [
+    {'column': 'UP', 'indicator': 'up'},
+    {'column': 'DOWN', 'indicator': 'down'},
+    {'column': 'RSI', 'indicator': 'rsi', 'period': 14},
+    {'column': 'EMA_50', 'indicator': 'ema', 'field': 'close', 'period': 50},
+    {'column': 'EMA_21', 'indicator': 'ema', 'field': 'close', 'period': 21},
+    {'column': 'EMA_9', 'indicator': 'ema', 'field': 'close', 'period': 9},
+    {'column': 'MACD', 'indicator': 'macd', 'fast': 12, 'slow': 26},
+    {'column': 'MACD_SIG', 'indicator': 'macd_signal', 'fast': 12, 'slow': 26, 'signal': 9},
+    {'column': 'VOL_EMA', 'indicator': 'ema', 'field': 'volume', 'period': 10},
+    {'column': 'P_CHANGE', 'indicator': 'pchange'}
+]
+
+EMA_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+def load_spec(path):
+    if (path is None):
+        return DEFAULT_SPEC
+    with open(path, 'r') as f_handle:
+        return json.load(f_handle)
+
+
+def macd_periods(entry):
+    return min(entry['fast'], entry['slow']), max(entry['fast'], entry['slow'])
+
+
+def default_entry(indicator):
+    # The incremental and market-wide TA paths compute the default set with
+    # built-in loops, they take its columns and periods from DEFAULT_SPEC and
+    # expect one column per indicator besides the EMAs.
+    entries = [entry for entry in DEFAULT_SPEC if entry['indicator'] == indicator]
+    if (len(entries) != 1):
+        raise Exception('The default indicator spec needs exactly one ' + indicator + ' column')
+    return entries[0]
+
+
+def default_emas():
+    return [(entry['column'], entry['field'], int(entry['period'])) for entry in DEFAULT_SPEC if entry['indicator'] == 'ema']
+
+
+def default_macd():
+    macd_entry = default_entry('macd')
+    signal_entry = default_entry('macd_signal')
+    if (macd_periods(macd_entry) != macd_periods(signal_entry)):
+        raise Exception('The default MACD and MACD signal columns need the same periods')
+    return macd_periods(macd_entry) + (int(signal_entry['signal']),)
+
+
+def output_node(entry):
+    # Returns the node that produces a spec entry and the column to take
+    # from that node's series.
+    indicator = entry['indicator']
+    if (indicator == 'up'):
+        return ('changes',), 'UP'
+    elif (indicator == 'down'):
+        return ('changes',), 'DOWN'
+    elif (indicator == 'rsi'):
+        return ('rsi', int(entry['period'])), 'RSI'
+    elif (indicator == 'ema'):
+        if (entry['field'] not in EMA_FIELDS):
+            raise Exception('Unknown field ' + str(entry['field']) + ' for column ' + entry['column'])
+        return ('ema', entry['field'], int(entry['period'])), 'EMA'
+    elif (indicator == 'macd'):
+        return ('macd',) + macd_periods(entry), 'MACD'
+    elif (indicator == 'macd_signal'):
+        return ('macd_signal',) + macd_periods(entry) + (int(entry['signal']),), 'MACD_SIG'
+    elif (indicator == 'pchange'):
+        return ('pchange',), 'PCHANGE'
+    raise Exception('Unknown indicator ' + str(indicator) + ' for column ' + str(entry.get('column')))
+
+
+def node_fields(key):
+    # OHLCV fields a node reads from the scrip data.
+    if (key[0] == 'changes' or key[0] == 'pchange'):
+        return ('open', 'close')
+    elif (key[0] == 'ema'):
+        return (key[1],)
+    return ()
+
+
+def dependencies(key):
+    if (key[0] == 'rsi'):
+        return [('changes',)]
+    elif (key[0] == 'macd'):
+        return [('ema', 'close', key[1]), ('ema', 'close', key[2])]
+    elif (key[0] == 'macd_signal'):
+        return [('macd', key[1], key[2])]
+    return []
+
+
+class IndicatorPlan(object):
+    # nodes are in dependency order, outputs are (column, node, source column),
+    # fields are the OHLCV fields the nodes read.
+
+    def __init__(self, nodes, outputs):
+        self.nodes = nodes
+        self.outputs = outputs
+        self.columns = [column for column, _, _ in outputs]
+        self.fields = [field for field in EMA_FIELDS if any(field in node_fields(key) for key in nodes)]
+
+    def run(self, ohlcv_data, compute_node):
+        results = {}
+        for key in self.nodes:
+            results[key] = compute_node(ohlcv_data, key, [results[dependency] for dependency in dependencies(key)])
+
+        data = Series(ohlcv_data.dates)
+        for column, key, source in self.outputs:
+            data.add_column_from(results[key], source, column)
+        return data
+
+
+def compile_spec(spec):
+    nodes = []
+    outputs = []
+
+    def schedule(key):
+        if (key in nodes):
+            return
+        for dependency in dependencies(key):
+            schedule(dependency)
+        nodes.append(key)
+
+    for entry in spec:
+        column = entry['column']
+        if (column == 'date' or column in [output[0] for output in outputs]):
+            raise Exception('Duplicate column ' + column + ' in indicator spec')
+        key, source = output_node(entry)
+        schedule(key)
+        outputs.append((column, key, source))
+
+    return IndicatorPlan(nodes, outputs)
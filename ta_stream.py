@@ -0,0 +1,191 @@
+import collections
+import csv
+import os
+import time
+import ta
+import ta_spec
+import ohlcv_store
+import profiling
+from metrics import METRICS, batch_result
+
+# Streaming TA: every node of the indicator plan becomes a stage that keeps
+# only its running state (window sums, the last EMA, the previous close) and
+# consumes one bar at a time. TA rows are written as the bars are read, so
+# memory stays at the longest window however long the history is. Each
+# stage repeats the per-bar arithmetic of the loops in ta.py, the output is
+# the same as a full calculation.
+
+
+class PriceChanges(object):
+    def step(self, bar, inputs):
+        if (bar['open'] >= bar['close']):
+            return {'UP': 0, 'DOWN': round(bar['open'] - bar['close'], 4)}
+        return {'UP': round(bar['close'] - bar['open'], 4), 'DOWN': 0}
+
+
+class Rsi(object):
+    def __init__(self, n):
+        self.n = n
+        self.count = 0
+        self.up = collections.deque()
+        self.down = collections.deque()
+        self.sum_up = 0
+        self.sum_down = 0
+
+    def step(self, bar, inputs):
+        i = self.count
+        self.count += 1
+        self.sum_up += inputs[0]['UP']
+        self.sum_down += inputs[0]['DOWN']
+        self.up.append(inputs[0]['UP'])
+        self.down.append(inputs[0]['DOWN'])
+
+        if (i >= self.n):
+            self.sum_up -= self.up.popleft()
+            self.sum_down -= self.down.popleft()
+
+        if (i < (self.n-1)):
+            return {'RSI': 'NA'}
+        if (self.sum_down <= 0.001):
+            return {'RSI': 100}
+        return {'RSI': round(100 - (100/(1+(self.sum_up/self.sum_down))), 4)}
+
+
+class Ema(object):
+    def __init__(self, field, n):
+        self.field = field
+        self.n = n
+        self.count = 0
+        self.sum = 0
+        self.ema = None
+
+    def step(self, bar, inputs):
+        i = self.count
+        self.count += 1
+        n = self.n
+
+        if (i < n):
+            self.sum += bar[self.field]
+        if (i == (n-1)):
+            self.ema = round(self.sum/n, 4)
+        elif (i >= n):
+            self.ema = round((bar[self.field]*(2/(1+n)))+(self.ema*(1 - (2/(n+1)))), 4)
+        else:
+            return {'EMA': 'NA'}
+        return {'EMA': self.ema}
+
+
+class MacdLine(object):
+    def __init__(self, high_n):
+        self.high_n = high_n
+        self.count = 0
+
+    def step(self, bar, inputs):
+        i = self.count
+        self.count += 1
+        if (i < (self.high_n - 1)):
+            return {'MACD': 'NA'}
+        return {'MACD': round(inputs[0]['EMA'] - inputs[1]['EMA'], 4)}
+
+
+class MacdSignal(object):
+    def __init__(self, high_n, signal):
+        self.high_n = high_n
+        self.signal = signal
+        self.count = 0
+        self.values = collections.deque()
+        self.sum = 0
+
+    def step(self, bar, inputs):
+        i = self.count
+        self.count += 1
+        start = self.high_n + self.signal - 2
+        if (i < (self.high_n - 1)):
+            return {'MACD_SIG': 'NA'}
+
+        value = inputs[0]['MACD']
+        if (i <= start):
+            self.sum += value
+        else:
+            self.sum += value - self.values.popleft()
+        self.values.append(value)
+
+        if (i < start):
+            return {'MACD_SIG': 'NA'}
+        return {'MACD_SIG': round(self.sum/self.signal, 4)}
+
+
+class PercentChange(object):
+    def __init__(self):
+        self.prev_close = None
+
+    def step(self, bar, inputs):
+        if (self.prev_close is None):
+            self.prev_close = bar['open']
+        value = round(100*(bar['close'] - self.prev_close)/self.prev_close, 4)
+        self.prev_close = bar['close']
+        return {'PCHANGE': value}
+
+
+def new_stage(key):
+    if (key[0] == 'changes'):
+        return PriceChanges()
+    elif (key[0] == 'rsi'):
+        return Rsi(key[1])
+    elif (key[0] == 'ema'):
+        return Ema(key[1], key[2])
+    elif (key[0] == 'macd'):
+        return MacdLine(key[2])
+    elif (key[0] == 'macd_signal'):
+        return MacdSignal(key[2], key[3])
+    return PercentChange()
+
+
+def stream_ta(bars, plan):
+    stages = [(key, new_stage(key), ta_spec.dependencies(key)) for key in plan.nodes]
+    for bar in bars:
+        results = {}
+        for key, stage, dependencies in stages:
+            results[key] = stage.step(bar, [results[dependency] for dependency in dependencies])
+        yield [bar['date']] + [results[key][source] for _, key, source in plan.outputs]
+
+
+def read_bars(datafile):
+    if (datafile.endswith(ohlcv_store.EXTENSION)):
+        for row in ohlcv_store.iter_rows(datafile):
+            yield dict(zip(ohlcv_store.FIELDS, row))
+        return
+
+    with open(datafile, 'r') as f_handle:
+        for row in csv.reader(f_handle):
+            yield {'date': row[0], 'open': ta.i2f(row[1]), 'high': ta.i2f(row[2]), 'low': ta.i2f(row[3]), 'close': ta.i2f(row[4]), 'volume': int(row[5])}
+
+
+def initialize_ta_data(datafile, destination_file):
+    ta.log('Streaming Technical Analysis data for %s to %s', datafile, destination_file)
+    start = time.perf_counter()
+    try:
+        with open(destination_file + '.tmp', 'w') as f_handle:
+            writer = csv.writer(f_handle)
+            writer.writerow(['date'] + ta.TA_PLAN.columns)
+            for row in stream_ta(read_bars(datafile), ta.TA_PLAN):
+                writer.writerow(row)
+    except Exception as e:
+        os.remove(destination_file + '.tmp')
+        raise
+
+    os.replace(destination_file + '.tmp', destination_file)
+    ta.record_scrip(datafile, start)
+
+
+def initialize_ta_batch(jobs):
+    processed = 0
+    for datafile, destination_file in jobs:
+        try:
+            with profiling.scrip(datafile):
+                initialize_ta_data(datafile, destination_file)
+            processed += 1
+        except Exception as e:
+            METRICS.increment('ta.failures')
+            ta.log('Failed to generate Technical Analysis data for %s: %s', datafile, e, error=True)
+    return batch_result(processed)
@@ -0,0 +1,111 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import downloader
+
+
+def zip_content():
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('cm01JAN2024bhav.csv', 'SYMBOL,SERIES,OPEN\n' + 'ABC,EQ,10.5\n' * 2000)
+    return content.getvalue()
+
+
+ZIP_CONTENT = zip_content()
+PART_SIZE = len(ZIP_CONTENT) // 2
+
+
+class BhavcopyHandler(BaseHTTPRequestHandler):
+    # Stands in for the exchange sites: /ok.zip is served, /missing.zip is a
+    # holiday, /flaky.zip fails with a 503 once and /resume.zip honours Range.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if (self.path == '/missing.zip'):
+            self.send_body(404, b'Not found')
+        elif (self.path == '/flaky.zip' and len([path for path, _ in self.server.requests if path == self.path]) == 1):
+            self.send_body(503, b'Busy')
+        elif (self.path == '/resume.zip' and self.headers.get('Range') is not None):
+            offset = int(self.headers.get('Range')[len('bytes='):-1])
+            self.send_body(206, ZIP_CONTENT[offset:], {'Content-Range': 'bytes %d-%d/%d' % (offset, len(ZIP_CONTENT) - 1, len(ZIP_CONTENT))})
+        else:
+            self.send_body(200, ZIP_CONTENT)
+
+    def send_body(self, status, body, headers = {}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipIf(not downloader.async_enabled(), 'aiohttp is not installed')
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BhavcopyHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.target_dir = tempfile.mkdtemp()
+        self.backoff = downloader.DOWNLOAD_BACKOFF
+        downloader.DOWNLOAD_BACKOFF = 0
+
+    def tearDown(self):
+        downloader.DOWNLOAD_BACKOFF = self.backoff
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.target_dir)
+
+    def download(self, name):
+        filename = os.path.join(self.target_dir, name)
+        return filename, downloader.download_files([(self.base_url + name, filename)])[filename]
+
+    def read(self, filename):
+        with open(filename, 'rb') as f_handle:
+            return f_handle.read()
+
+    def test_ok(self):
+        filename, result = self.download('ok.zip')
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['attempts'], 1)
+        self.assertEqual(result['size'], len(ZIP_CONTENT))
+        self.assertEqual(self.read(filename), ZIP_CONTENT)
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+    def test_not_found_is_not_retried(self):
+        filename, result = self.download('missing.zip')
+        self.assertEqual(result['status'], 404)
+        self.assertEqual(result['attempts'], 1)
+        self.assertFalse(downloader.is_transient(result['status']))
+        self.assertFalse(os.path.exists(filename))
+
+    def test_transient_error_is_retried(self):
+        filename, result = self.download('flaky.zip')
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['attempts'], 2)
+        self.assertEqual(self.read(filename), ZIP_CONTENT)
+
+    def test_partial_file_is_resumed(self):
+        filename = os.path.join(self.target_dir, 'resume.zip')
+        with open(filename + '.part', 'wb') as f_handle:
+            f_handle.write(ZIP_CONTENT[:PART_SIZE])
+
+        filename, result = self.download('resume.zip')
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(self.server.requests, [('/resume.zip', 'bytes=%d-' % PART_SIZE)])
+        self.assertEqual(self.read(filename), ZIP_CONTENT)
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import csv
+import datetime
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import ta
+import ta_incremental
+import ta_stream
+
+try:
+    import ta_market
+except ImportError:
+    ta_market = None
+
+
+def reference_ema(values, n):
+    # Per-row loop of the original dict based implementation.
+    ema = []
+    total = 0
+    for i, value in enumerate(values):
+        total += value
+        if (i == n - 1):
+            ema.append(round(total/n, 4))
+        elif (i >= n):
+            ema.append(round((value*(2/(1+n))) + (ema[i-1]*(1 - (2/(n+1)))), 4))
+        else:
+            ema.append('NA')
+    return ema
+
+
+def reference_rows(bars):
+    up = []
+    down = []
+    rsi = []
+    sum_up = 0
+    sum_down = 0
+    for i, bar in enumerate(bars):
+        if (bar['open'] >= bar['close']):
+            up.append(0)
+            down.append(round(bar['open'] - bar['close'], 4))
+        else:
+            up.append(round(bar['close'] - bar['open'], 4))
+            down.append(0)
+
+        sum_up += up[i]
+        sum_down += down[i]
+        if (i >= 14):
+            sum_up -= up[i-14]
+            sum_down -= down[i-14]
+        if (i < 13):
+            rsi.append('NA')
+        elif (sum_down <= 0.001):
+            rsi.append(100)
+        else:
+            rsi.append(round(100 - (100/(1+(sum_up/sum_down))), 4))
+
+    closes = [bar['close'] for bar in bars]
+    ema_50 = reference_ema(closes, 50)
+    ema_21 = reference_ema(closes, 21)
+    ema_9 = reference_ema(closes, 9)
+    ema_12 = reference_ema(closes, 12)
+    ema_26 = reference_ema(closes, 26)
+    vol_ema = reference_ema([bar['volume'] for bar in bars], 10)
+
+    macd = []
+    macd_signal = []
+    sum_macd = 0
+    for i in range(len(bars)):
+        macd.append('NA' if (i < 25) else round(ema_12[i] - ema_26[i], 4))
+        if (i < 25):
+            macd_signal.append('NA')
+        elif (i < 33):
+            sum_macd += macd[i]
+            macd_signal.append('NA')
+        elif (i == 33):
+            sum_macd += macd[i]
+            macd_signal.append(round(sum_macd/9, 4))
+        else:
+            sum_macd += macd[i] - macd[i-9]
+            macd_signal.append(round(sum_macd/9, 4))
+
+    rows = []
+    prev_close = bars[0]['open'] if (len(bars) > 0) else None
+    for i, bar in enumerate(bars):
+        pchange = round(100*(bar['close'] - prev_close)/prev_close, 4)
+        prev_close = bar['close']
+        rows.append([bar['date'], up[i], down[i], rsi[i], ema_50[i], ema_21[i], ema_9[i], macd[i], macd_signal[i], vol_ema[i], pchange])
+    return rows
+
+
+def reference_output(bars):
+    content = io.StringIO()
+    writer = csv.writer(content)
+    writer.writerow(['date', 'UP', 'DOWN', 'RSI', 'EMA_50', 'EMA_21', 'EMA_9', 'MACD', 'MACD_SIG', 'VOL_EMA', 'P_CHANGE'])
+    writer.writerows(reference_rows(bars))
+    return content.getvalue()
+
+
+def make_bars(count, seed, flat_every = 0, rising = 0):
+    # flat_every puts an open == close bar in every so many rows, the first
+    # rising bars all close above their open so the RSI saturates at 100.
+    generator = random.Random(seed)
+    start = datetime.date(2020, 1, 1)
+    price = 100 + generator.random()*50
+    bars = []
+    for i in range(count):
+        open_price = round(price, 2)
+        if (i < rising):
+            close_price = round(open_price + 0.05 + generator.random(), 2)
+        elif (flat_every > 0 and i % flat_every == 0):
+            close_price = open_price
+        else:
+            close_price = round(open_price*(1 + generator.uniform(-0.04, 0.04)), 2)
+        high = max(open_price, close_price) + round(generator.random(), 2)
+        low = min(open_price, close_price) - round(generator.random(), 2)
+        bars.append({'date': (start + datetime.timedelta(days=i)).isoformat(), 'open': open_price, 'high': round(high, 2), 'low': round(low, 2), 'close': close_price, 'volume': generator.randint(100, 500000)})
+        price = close_price
+    return bars
+
+
+FIXTURES = {
+    'WARM13': make_bars(13, 1),
+    'WARM14': make_bars(14, 2),
+    'WARM25': make_bars(25, 3),
+    'WARM26': make_bars(26, 4),
+    'WARM34': make_bars(34, 5),
+    'WARM35': make_bars(35, 6),
+    'FLAT': make_bars(80, 7, flat_every=3),
+    'SATURATED': make_bars(60, 8, rising=30),
+}
+
+
+class TechnicalAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.target_dir = tempfile.mkdtemp()
+        self.backend = ta.TA_BACKEND
+
+    def tearDown(self):
+        ta.TA_BACKEND = self.backend
+        shutil.rmtree(self.target_dir)
+
+    def datafile(self, name, bars):
+        filename = os.path.join(self.target_dir, name + '.csv')
+        with open(filename, 'a') as f_handle:
+            csv.writer(f_handle).writerows([[bar['date'], bar['open'], bar['high'], bar['low'], bar['close'], bar['volume']] for bar in bars])
+        return filename
+
+    def read(self, filename):
+        with open(filename, 'r', newline='') as f_handle:
+            return f_handle.read()
+
+    def assert_reference(self, initialize):
+        for name, bars in FIXTURES.items():
+            with self.subTest(scrip=name):
+                datafile = self.datafile(name, bars)
+                destination_file = os.path.join(self.target_dir, name + '_ta.csv')
+                initialize(datafile, destination_file)
+                self.assertEqual(self.read(destination_file), reference_output(bars))
+
+    def test_fixture_covers_saturated_rsi(self):
+        self.assertIn(100, [row[3] for row in reference_rows(FIXTURES['SATURATED'])])
+
+    def test_python_backend(self):
+        ta.TA_BACKEND = 'python'
+        self.assert_reference(ta.initialize_ta_data)
+
+    @unittest.skipIf(ta.ta_numpy is None, 'numpy is not installed')
+    def test_numpy_backend(self):
+        ta.TA_BACKEND = 'numpy'
+        self.assert_reference(ta.initialize_ta_data)
+
+    def test_stream(self):
+        self.assert_reference(ta_stream.initialize_ta_data)
+
+    def test_incremental(self):
+        for name, bars in FIXTURES.items():
+            with self.subTest(scrip=name):
+                destination_file = os.path.join(self.target_dir, name + '_ta.csv')
+                state_file = os.path.join(self.target_dir, name + '.state')
+                # Appended a few days at a time like the daily updates.
+                for start in range(0, len(bars), 6):
+                    datafile = self.datafile(name, bars[start:start + 6])
+                    ta_incremental.update_ta_data(datafile, destination_file, state_file)
+                    self.assertEqual(self.read(destination_file), reference_output(bars[:start + 6]))
+
+    @unittest.skipIf(ta_market is None, 'numpy is not installed')
+    def test_market(self):
+        jobs = []
+        for name, bars in FIXTURES.items():
+            jobs.append((self.datafile(name, bars), os.path.join(self.target_dir, name + '_ta.csv')))
+        ta_market.initialize_ta_batch(jobs)
+        for (_, destination_file), bars in zip(jobs, FIXTURES.values()):
+            self.assertEqual(self.read(destination_file), reference_output(bars))
+
+
+if __name__ == '__main__':
+    unittest.main()
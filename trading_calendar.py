@@ -0,0 +1,63 @@
+import json
+import os
+
+CALENDAR_FILE = 'trading_calendar.json'
+HOLIDAYS_FILE = 'holidays.dat'
+
+# National holidays on which both exchanges are closed every year (MM-DD).
+FIXED_HOLIDAYS = ['01-26', '08-15', '10-02', '12-25']
+
+
+class TradingCalendar(object):
+    # Holidays learned per exchange from bhavcopies that came back as 404,
+    # plus any dates listed one per line in holidays.dat. It is kept next to
+    # the scripts, outside data/, so it survives a fresh init.
+
+    def __init__(self, path = CALENDAR_FILE, holidays_file = HOLIDAYS_FILE):
+        self.path = path
+        self.holidays_file = holidays_file
+        self.holidays = {}
+        self.known_holidays = set()
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f_handle:
+                self.holidays = {exchange: set(dates) for exchange, dates in json.load(f_handle).items()}
+        except Exception as e:
+            self.holidays = {}
+
+        try:
+            with open(self.holidays_file, 'r') as f_handle:
+                self.known_holidays = set(line.strip() for line in f_handle if line.strip() and not line.startswith('#'))
+        except Exception as e:
+            self.known_holidays = set()
+
+        self.changed = False
+        return self
+
+    def is_trading_day(self, exchange, t_date):
+        if (t_date.weekday() > 4):
+            return False
+
+        key = str(t_date)
+        if (key[5:] in FIXED_HOLIDAYS or key in self.known_holidays):
+            return False
+
+        return key not in self.holidays.get(exchange, ())
+
+    def mark_holiday(self, exchange, t_date):
+        if (exchange not in self.holidays):
+            self.holidays[exchange] = set()
+        self.holidays[exchange].add(str(t_date))
+        self.changed = True
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f_handle:
+            json.dump({exchange: sorted(dates) for exchange, dates in self.holidays.items()}, f_handle, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+
+def load_calendar():
+    return TradingCalendar().load()